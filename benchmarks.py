@@ -0,0 +1,106 @@
+"""Allocation benchmark of the request-response cycle.
+
+Usage: python benchmarks.py [<num-requests>]
+"""
+import asyncio
+import sys
+import tracemalloc
+
+from femtoweb.server import (
+    GET,
+    _200,
+    route,
+    service_connection,
+)
+
+###############################################################################
+# In-memory connection
+###############################################################################
+
+class NullTransport:
+    def abort(self):
+        pass
+
+class NullWriter:
+    """A StreamWriter-compatible sink that discards everything written to it.
+    """
+    transport = NullTransport()
+
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+class FileBody:
+    """A file-type body that yields num_bytes zeros.
+    """
+    def __init__(self, num_bytes):
+        self.remaining = num_bytes
+
+    def readinto(self, buf):
+        n = min(len(buf), self.remaining)
+        self.remaining -= n
+        return n
+
+###############################################################################
+# Routes
+###############################################################################
+
+@route('/_bench/text', methods=(GET,))
+async def text(request):
+    return _200(body='hello')
+
+@route('/_bench/file', methods=(GET,))
+async def file(request):
+    return _200(headers={'content-type': 'text/plain'}, body=FileBody(8192))
+
+REQUESTS = (
+    b'GET /_bench/text HTTP/1.1\r\nhost: localhost\r\n\r\n',
+    b'GET /_bench/file?x=1 HTTP/1.1\r\nhost: localhost\r\n\r\n',
+    b'GET /_bench/missing HTTP/1.1\r\nhost: localhost\r\n\r\n',
+)
+
+###############################################################################
+# Benchmark
+###############################################################################
+
+async def cycle(data):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    await service_connection(reader, NullWriter())
+
+async def run(num_requests):
+    # Warm up any caches before measuring.
+    for data in REQUESTS:
+        await cycle(data)
+
+    tracemalloc.start()
+    start_size, _ = tracemalloc.get_traced_memory()
+    total_peak = 0
+    for i in range(num_requests):
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        await cycle(REQUESTS[i % len(REQUESTS)])
+        total_peak += tracemalloc.get_traced_memory()[1] - size
+    end_size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('requests: {}'.format(num_requests))
+    print('mean peak bytes per request: {:.0f}'.format(
+        total_peak / num_requests
+    ))
+    print('net retained bytes: {}'.format(end_size - start_size))
+
+if __name__ == '__main__':
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 3000))
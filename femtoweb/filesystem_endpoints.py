@@ -1,27 +1,50 @@
 """HTTP endpoints definitions for filesystem operations.
 """
 from os import path
+import asyncio
+import hashlib
+import json
 import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import threading
+import zipfile
 
 from .filesystem_views import (
     FilesystemDirectoryListing,
     TextFileEditor,
 )
 
+from .multipart import (
+    DEFAULT_MAX_PART_BYTES,
+    DEFAULT_MAX_TOTAL_BYTES,
+    MultipartParser,
+)
+
 from .server import (
     APPLICATION_JSON,
     APPLICATION_PYTHON,
+    APPLICATION_TAR,
+    APPLICATION_ZIP,
     DELETE,
+    MULTIPART_FORM_DATA,
     GET,
     POST,
     PUT,
     TEXT_HTML,
     TEXT_PLAIN,
+    ChunkStream,
     _200,
     _303,
+    _400,
     _404,
+    drain,
     get_file_path_content_type,
+    read_body,
     route,
+    trace_span,
 )
 
 ###############################################################################
@@ -38,6 +61,314 @@ EDITABLE_CONTENT_TYPES = (
 # Set the default public filesystem root to "<this-directory>/public".
 DEFAULT_PUBLIC_ROOT = path.join(path.dirname(__file__), 'public')
 
+ARCHIVE_TAR = 'tar'
+ARCHIVE_ZIP = 'zip'
+
+# The number of bytes to read from a file, or from the request body, at a time
+# when creating or extracting an archive, or hashing a file.
+ARCHIVE_CHUNK_BYTES = 65536
+
+###############################################################################
+# Archive helpers
+###############################################################################
+
+class InvalidArchive(Exception): pass
+
+def _walk(fs_path):
+    """Yield (<archive-name>, <fs-path>, <stat-result>) tuples for all of the
+    directories and regular files under fs_path.
+    """
+    for dirpath, dirnames, filenames in os.walk(fs_path):
+        for name in dirnames + filenames:
+            item_path = path.join(dirpath, name)
+            try:
+                st = os.stat(item_path)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode) or stat.S_ISREG(st.st_mode):
+                arcname = path.relpath(item_path, fs_path).replace(os.sep, '/')
+                yield arcname, item_path, st
+
+def _read_chunks(fs_path, size):
+    """Yield exactly size bytes from the file, in chunks, truncating or
+    zero-padding it if it changed size since it was stat'd.
+    """
+    remaining = size
+    with open(fs_path, 'rb') as fh:
+        while remaining:
+            chunk = fh.read(min(remaining, ARCHIVE_CHUNK_BYTES))
+            if not chunk:
+                chunk = bytes(min(remaining, ARCHIVE_CHUNK_BYTES))
+            remaining -= len(chunk)
+            yield chunk
+
+def iter_tar(fs_path):
+    """Yield a tar archive of the directory at fs_path in chunks.
+    """
+    num_bytes = 0
+    for arcname, item_path, st in _walk(fs_path):
+        info = tarfile.TarInfo(arcname)
+        info.mtime = st.st_mtime
+        info.mode = stat.S_IMODE(st.st_mode)
+        if stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+        else:
+            info.size = st.st_size
+        header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        num_bytes += len(header)
+        yield header
+        if info.size:
+            yield from _read_chunks(item_path, info.size)
+            # Pad the file data to a whole number of blocks.
+            remainder = info.size % tarfile.BLOCKSIZE
+            padding = bytes(tarfile.BLOCKSIZE - remainder if remainder else 0)
+            num_bytes += info.size + len(padding)
+            yield padding
+    # End the archive with two empty blocks, padded to a whole number of
+    # records.
+    num_bytes += 2 * tarfile.BLOCKSIZE
+    remainder = num_bytes % tarfile.RECORDSIZE
+    yield bytes(
+        2 * tarfile.BLOCKSIZE +
+        (tarfile.RECORDSIZE - remainder if remainder else 0)
+    )
+
+class _ChunkSink:
+    """A write-only, unseekable file that collects the written chunks.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+def iter_zip(fs_path):
+    """Yield an uncompressed zip archive of the directory at fs_path in chunks.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w') as zf:
+        for arcname, item_path, st in _walk(fs_path):
+            zinfo = zipfile.ZipInfo.from_file(item_path, arcname)
+            if zinfo.is_dir():
+                zf.writestr(zinfo, b'')
+            else:
+                with zf.open(zinfo, 'w') as fh:
+                    for chunk in _read_chunks(item_path, zinfo.file_size):
+                        fh.write(chunk)
+                        yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
+
+ARCHIVE_ITERATORS = {
+    ARCHIVE_TAR: (iter_tar, APPLICATION_TAR),
+    ARCHIVE_ZIP: (iter_zip, APPLICATION_ZIP),
+}
+
+class _BodyReader:
+    """A synchronous file-type reader of a request body, for use by tarfile in
+    a worker thread, that fetches chunks from the event loop.
+    """
+    def __init__(self, request, loop):
+        self.chunks = read_body(request, ARCHIVE_CHUNK_BYTES)
+        self.loop = loop
+        self.buf = b''
+        self.eof = False
+
+    def _next_chunk(self):
+        try:
+            return asyncio.run_coroutine_threadsafe(
+                self.chunks.__anext__(), self.loop
+            ).result()
+        except StopAsyncIteration:
+            self.eof = True
+            return b''
+
+    def read(self, n=-1):
+        while not self.eof and (n < 0 or len(self.buf) < n):
+            self.buf += self._next_chunk()
+        if n < 0:
+            n = len(self.buf)
+        data, self.buf = self.buf[:n], self.buf[n:]
+        return data
+
+def _member_path(root, name, is_dir=False):
+    """Return the path at which to extract the named archive member, or None
+    for a directory member that is root itself, e.g. the "./" member of an
+    archive created with "tar -C <dir> -cf <file> .", raising InvalidArchive
+    if it would be outside of root.
+    """
+    parts = name.split('/')
+    if path.isabs(name) or '..' in parts:
+        raise InvalidArchive('Invalid member path: {}'.format(name))
+    fs_path = path.realpath(path.join(root, *parts))
+    root = path.realpath(root)
+    if is_dir and fs_path == root:
+        return None
+    if not fs_path.startswith(root + os.sep):
+        raise InvalidArchive('Invalid member path: {}'.format(name))
+    return fs_path
+
+def merge_dirs(src, dst):
+    """Move the files under src into the same relative paths under dst,
+    replacing any existing files.
+    """
+    for dirpath, dirnames, filenames in os.walk(src):
+        dst_dirpath = path.join(dst, path.relpath(dirpath, src))
+        os.makedirs(dst_dirpath, exist_ok=True)
+        for filename in filenames:
+            os.replace(path.join(dirpath, filename),
+                       path.join(dst_dirpath, filename))
+
+def extract_tar(fileobj, root):
+    """Extract the directories and regular files of a tar stream into root.
+    """
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+        for member in tar:
+            fs_path = _member_path(root, member.name, member.isdir())
+            if fs_path is None:
+                continue
+            elif member.isdir():
+                os.makedirs(fs_path, exist_ok=True)
+            elif member.isreg():
+                os.makedirs(path.dirname(fs_path), exist_ok=True)
+                src = tar.extractfile(member)
+                with open(fs_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, ARCHIVE_CHUNK_BYTES)
+            else:
+                raise InvalidArchive(
+                    'Unsupported member type: {}'.format(member.name)
+                )
+
+###############################################################################
+# Manifest helpers
+###############################################################################
+
+def default_index_path(public_root):
+    """Return the path of the hash index file for a public root, which is a
+    sibling of the root so that the index itself is not served.
+    """
+    return path.normpath(public_root) + '.index.json'
+
+def _hash_index_key(st):
+    return '{}:{}'.format(st.st_dev, st.st_ino)
+
+class HashIndex:
+    """A persistent map of file device and inode numbers to their last-seen
+    mtime, size, SHA-256 hash and path, used to avoid re-hashing unchanged
+    files.
+    """
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.entries = None
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'r') as fh:
+                entries = json.load(fh)
+        except (OSError, ValueError):
+            entries = {}
+        # Discard any entries in an older format.
+        self.entries = {k: v for k, v in entries.items() if len(v) == 4}
+        self.dirty = len(self.entries) != len(entries)
+
+    def get_hash(self, fs_path, st):
+        """Return the hex SHA-256 hash of the file, computing it only if the
+        file has changed since it was last hashed.
+        """
+        key = _hash_index_key(st)
+        fs_path = path.normpath(fs_path)
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            entry = self.entries.get(key)
+            if (entry is not None and
+                entry[:2] == [st.st_mtime_ns, st.st_size]):
+                if entry[3] != fs_path:
+                    # The file was renamed.
+                    entry[3] = fs_path
+                    self.dirty = True
+                return entry[2]
+        sha = hashlib.sha256()
+        with open(fs_path, 'rb') as fh:
+            while True:
+                chunk = fh.read(ARCHIVE_CHUNK_BYTES)
+                if not chunk:
+                    break
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        with self.lock:
+            self.entries[key] = [st.st_mtime_ns, st.st_size, digest, fs_path]
+            self.dirty = True
+        return digest
+
+    def prune(self, fs_path, keys):
+        """Remove the entries of files under the directory fs_path whose keys
+        aren't in keys, i.e. those that no longer exist.
+        """
+        prefix = path.join(path.normpath(fs_path), '')
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            stale = [
+                k for k, entry in self.entries.items()
+                if k not in keys and entry[3].startswith(prefix)
+            ]
+            for k in stale:
+                del self.entries[k]
+            if stale:
+                self.dirty = True
+
+    def save(self):
+        """Atomically write the index to disk if it has changed.
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as fh:
+                json.dump(self.entries, fh)
+            os.replace(tmp_path, self.index_path)
+            self.dirty = False
+
+# Map index paths to their HashIndex instances.
+_hash_indexes = {}
+
+def get_hash_index(index_path):
+    if index_path not in _hash_indexes:
+        _hash_indexes[index_path] = HashIndex(index_path)
+    return _hash_indexes[index_path]
+
+def build_manifest(fs_path, hash_index):
+    """Return a list of path, size, mtime and sha256 dicts for the regular
+    files under fs_path.
+    """
+    files = []
+    keys = set()
+    for arcname, item_path, st in _walk(fs_path):
+        if stat.S_ISREG(st.st_mode):
+            files.append({
+                'path': arcname,
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'sha256': hash_index.get_hash(item_path, st),
+            })
+            keys.add(_hash_index_key(st))
+    # Remove the entries of files that were deleted or replaced, e.g. by a
+    # merge upload, which creates a new inode for each file.
+    hash_index.prune(fs_path, keys)
+    hash_index.save()
+    return files
+
 ###############################################################################
 # Endpoint helpers
 ###############################################################################
@@ -46,86 +377,212 @@ def _fs_GET(public_root, req_path):
     """Handle a filesystem GET request.
     """
     fs_path = path.join(public_root, req_path)
-    if not path.exists(fs_path):
-        return _404()
+    with trace_span('fs.stat', {'path': req_path}):
+        if not path.exists(fs_path):
+            return _404()
+        is_dir = path.isdir(fs_path)
 
     # The request path is a directory, return an HTML directory listing.
-    if path.isdir(fs_path):
+    if is_dir:
         return _200(body=FilesystemDirectoryListing(fs_path, req_path))
 
     # The requested path is a file, so return it.
     content_type = get_file_path_content_type(fs_path)
-    return _200(
-        headers={'content-type': content_type},
-        body=open(fs_path, 'rb')
-    )
+    with trace_span('fs.open', {'path': req_path}):
+        fh = open(fs_path, 'rb')
+    return _200(headers={'content-type': content_type}, body=fh)
 
 def _fs_GET_edit(public_root, req_path, create):
     fs_path = path.join(public_root, req_path)
     if path.exists(fs_path):
-        text = open(fs_path, 'rb').read().decode('utf-8')
+        body = TextFileEditor(req_path, fs_path)
     elif not create:
         return _404()
     else:
-        text = ''
-    body = TextFileEditor(req_path, text)
+        body = TextFileEditor(req_path)
     return _200(body=body)
 
 
+async def _maybe_send_continue(request):
+    if request.headers.get('expect') == '100-continue':
+        request.writer.write(b'HTTP/1.1 100 Continue\r\n')
+        request.writer.write(b'\r\n')
+        await drain(request.writer)
+
+def _fs_GET_archive(public_root, req_path, archive):
+    """Handle a filesystem GET request for an archive of a directory.
+    """
+    fs_path = path.join(public_root, req_path)
+    if not path.isdir(fs_path):
+        return _404()
+    iter_archive, content_type = ARCHIVE_ITERATORS[archive]
+    name = path.basename(path.normpath(fs_path))
+    return _200(
+        headers={
+            'content-type': content_type,
+            'content-disposition':
+                'attachment; filename="{}.{}"'.format(name, archive),
+        },
+        body=ChunkStream(iter_archive(fs_path)),
+    )
+
 async def _fs_PUT(public_root, req_path, request):
     """Handle a filesystem PUT request.
     """
     # TODO - validate the request (e.g. check for avail drive space, whether
     # directory already exists with same name, etc.))
-    if request.headers.get('expect') == '100-continue':
-        request.writer.write('HTTP/1.1 100 Continue\r\n')
-        request.writer.write('\r\n')
-        await request.writer.drain()
+    await _maybe_send_continue(request)
 
     # TODO - write to a temporary file and rename to target on success.
     MAX_CHUNK_BYTES = 1024
-    with open(path.join(public_root, req_path), 'wb') as fh:
-        bytes_remaining = int(request.headers['content-length'])
-
-        # First yield from the body if non-empty.
-        body = request.body
-        while body:
-            chunk = body[:MAX_CHUNK_BYTES]
-            body = body[MAX_CHUNK_BYTES:]
+    with trace_span('fs.write', {'path': req_path}), \
+         open(path.join(public_root, req_path), 'wb') as fh:
+        async for chunk in read_body(request, MAX_CHUNK_BYTES):
             fh.write(chunk)
-            bytes_remaining -= len(chunk)
 
-        # If we need more bytes, receive them from the socket.
-        while bytes_remaining:
-            chunk = await request.reader.read(
-                min(bytes_remaining, MAX_CHUNK_BYTES)
+    return _303(location='/_fs/{}'.format(req_path))
+
+async def _fs_POST_multipart(public_root, req_path, request, max_part_bytes,
+                             max_total_bytes):
+    """Handle a filesystem POST request of a multipart/form-data body by
+    saving each of its file parts into the target directory.
+    """
+    fs_path = path.join(public_root, req_path)
+    if not path.isdir(fs_path):
+        return _404()
+
+    await _maybe_send_continue(request)
+
+    async for part in MultipartParser(request, max_part_bytes,
+                                      max_total_bytes):
+        if not part.filename:
+            continue
+        # Only use the final component of the client-specified filename.
+        filename = path.basename(part.filename.replace('\\', '/'))
+        if filename in ('', '.', '..'):
+            return _400('Invalid filename: {}'.format(part.filename))
+        # Write to a temporary file and rename it to the target on success.
+        with trace_span('fs.write', {'path': req_path, 'file': filename}):
+            fd, tmp_path = tempfile.mkstemp(prefix='.upload-', dir=fs_path)
+            try:
+                with os.fdopen(fd, 'wb') as fh:
+                    async for chunk in part:
+                        fh.write(chunk)
+                os.replace(tmp_path, path.join(fs_path, filename))
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+    return _303(location='/_fs/{}'.format(
+        (req_path.rstrip('/') + '/') if req_path else ''
+    ))
+
+async def _fs_GET_manifest(public_root, req_path, index_path):
+    """Handle a filesystem GET request for the manifest of a directory.
+    """
+    fs_path = path.join(public_root, req_path)
+    if not path.isdir(fs_path):
+        return _404()
+    with trace_span('fs.manifest', {'path': req_path}):
+        files = await asyncio.get_event_loop().run_in_executor(
+            None, build_manifest, fs_path, get_hash_index(index_path)
+        )
+    return _200(
+        headers={'content-type': APPLICATION_JSON},
+        body=json.dumps({'files': files}),
+    )
+
+async def _fs_PUT_archive(public_root, req_path, request, merge):
+    """Handle a filesystem PUT or POST request of a tar archive by extracting
+    it into a temporary directory and, on success, either replacing the target
+    directory with it or, if merge is True, moving the extracted files into
+    the target directory.
+    """
+    root = path.normpath(public_root)
+    fs_path = path.normpath(path.join(root, req_path))
+    # Require the target to be a directory within, but not the same as, the
+    # public root, unless merging.
+    if not (fs_path.startswith(root + os.sep) or
+            (merge and fs_path == root)):
+        return _400('Invalid path')
+    parent = path.dirname(fs_path)
+    if not path.isdir(parent):
+        return _404()
+
+    await _maybe_send_continue(request)
+
+    loop = asyncio.get_event_loop()
+    tmp_path = tempfile.mkdtemp(prefix='.archive-', dir=parent)
+    try:
+        with trace_span('fs.extract', {'path': req_path}):
+            await loop.run_in_executor(
+                None, extract_tar, _BodyReader(request, loop), tmp_path
             )
-            fh.write(chunk)
-            bytes_remaining -= len(chunk)
+    except (InvalidArchive, tarfile.TarError) as e:
+        shutil.rmtree(tmp_path)
+        return _400(str(e))
+    except BaseException:
+        shutil.rmtree(tmp_path)
+        raise
 
-    return _303(location='/_fs/{}'.format(req_path))
+    if merge:
+        # Move each extracted file into place.
+        try:
+            with trace_span('fs.merge', {'path': req_path}):
+                merge_dirs(tmp_path, fs_path)
+        finally:
+            shutil.rmtree(tmp_path)
+    else:
+        # Swap the extracted directory into place.
+        with trace_span('fs.replace', {'path': req_path}):
+            old_path = None
+            if path.exists(fs_path):
+                old_path = tempfile.mkdtemp(prefix='.archive-old-',
+                                            dir=parent)
+                os.rename(fs_path, path.join(old_path, 'old'))
+            os.rename(tmp_path, fs_path)
+            if old_path is not None:
+                shutil.rmtree(old_path)
+
+    return _303(location='/_fs/{}/'.format(req_path.rstrip('/')))
 
 def _fs_DELETE(public_root, req_path):
     """Handle a filesystem DELETE request.
     """
     fs_path = path.join(public_root, req_path)
-    if not path.exists(fs_path):
-        return _404()
-    os.remove(fs_path)
+    with trace_span('fs.delete', {'path': req_path}):
+        if not path.exists(fs_path):
+            return _404()
+        os.remove(fs_path)
     return _200()
 
 ###############################################################################
 # Filesystem operation dispatcher
 ###############################################################################
 
-async def filesystem(request, public_root):
-    """Handle filesystem operations.
+async def filesystem(request, public_root, index_path=None,
+                     max_part_bytes=DEFAULT_MAX_PART_BYTES,
+                     max_total_bytes=DEFAULT_MAX_TOTAL_BYTES):
+    """Handle filesystem operations, limiting the size of each file and the
+    whole body of multipart uploads to max_part_bytes and max_total_bytes.
     """
     # Strip any leading slash to prevent path.join() from resolving relative to
     # the filesystem root.
     req_path = request.path[4:].lstrip('/')
 
+    archive = request.query.get('archive')
+    if archive is not None and archive not in ARCHIVE_ITERATORS:
+        return _400('Unsupported archive format: {}'.format(archive))
+
     if request.method == 'GET':
+        if archive is not None:
+            return _fs_GET_archive(public_root, req_path, archive)
+        if request.query.get('manifest') == '1':
+            return await _fs_GET_manifest(
+                public_root,
+                req_path,
+                index_path or default_index_path(public_root)
+            )
         if (request.query.get('edit') == '1' and
             get_file_path_content_type(req_path) in EDITABLE_CONTENT_TYPES):
             create = request.query.get('create') == '1'
@@ -133,8 +590,22 @@ async def filesystem(request, public_root):
         else:
             return _fs_GET(public_root, req_path)
 
-    elif request.method == 'PUT':
-        return await _fs_PUT(public_root, req_path, request)
+    elif request.method in (PUT, POST):
+        if archive == ARCHIVE_TAR:
+            merge = request.query.get('merge') == '1'
+            return await _fs_PUT_archive(public_root, req_path, request, merge)
+        elif archive is not None:
+            return _400('Only tar archives can be uploaded')
+        elif request.method == PUT:
+            return await _fs_PUT(public_root, req_path, request)
+        elif (request.headers.get('content-type', '')
+              .startswith(MULTIPART_FORM_DATA)):
+            return await _fs_POST_multipart(
+                public_root, req_path, request, max_part_bytes, max_total_bytes
+            )
+        return _400('Expected archive=tar or Content-Type: {}'.format(
+            MULTIPART_FORM_DATA
+        ))
 
     elif request.method == 'DELETE':
         return _fs_DELETE(public_root, req_path)
@@ -143,9 +614,15 @@ async def filesystem(request, public_root):
 # Route attacher
 ###############################################################################
 
-def attach(public_root=DEFAULT_PUBLIC_ROOT):
-    """Add a route for the filesystem operation endpoints.
+def attach(public_root=DEFAULT_PUBLIC_ROOT, index_path=None,
+           rate_limit=None, max_part_bytes=DEFAULT_MAX_PART_BYTES,
+           max_total_bytes=DEFAULT_MAX_TOTAL_BYTES):
+    """Add a route for the filesystem operation endpoints, optionally
+    specifying the path of the manifest hash index file, a RateLimiter, and
+    the multipart upload size limits (None for no limit).
     """
-    @route('^((/_fs/?)|(/_fs/.+))$', methods=(GET, PUT, DELETE))
+    @route('^((/_fs/?)|(/_fs/.+))$', methods=(GET, PUT, POST, DELETE),
+           rate_limit=rate_limit)
     async def _filesystem(request):
-        return await filesystem(request, public_root)
+        return await filesystem(request, public_root, index_path,
+                                max_part_bytes, max_total_bytes)
@@ -1,97 +1,210 @@
-
+import codecs
+import json
 import os
+import re
+from html import escape
 from os import path
 
-from .lib.htmlephant import (
-    Anchor,
-    Button,
-    Div,
-    DocumentStream,
-    Script,
-    Span,
-    Style,
-    Textarea,
-)
+from .server import ChunkStream
+
+###############################################################################
+# Templates
+###############################################################################
+
+# The number of bytes to read from a file at a time when streaming its
+# contents into a page.
+FILE_CHUNK_BYTES = 8192
+
+# Match "{{name}}" and "{{name|filter}}" slots.
+SLOT_REGEX = re.compile(r'\{\{(\w+)(?:\|(\w+))?\}\}')
+
+def _js_string(s):
+    # Encode as a JS string literal that can't terminate the enclosing
+    # <script> element.
+    return json.dumps(s).replace('</', '<\\/')
+
+SLOT_FILTERS = {
+    'html': lambda s: escape(s, quote=True),
+    'js': _js_string,
+}
+
+class Template:
+    """An HTML template whose static fragments are encoded to bytes once, at
+    compile time, and whose slot values are escaped as they are rendered.
+    """
+    def __init__(self, source):
+        # Store the template as a tuple of alternating <static-bytes> and
+        # (<slot-name>, <filter-func>) items.
+        parts = []
+        pos = 0
+        for match in SLOT_REGEX.finditer(source):
+            parts.append(source[pos:match.start()].encode('utf-8'))
+            name, filter_name = match.groups()
+            parts.append((name, SLOT_FILTERS[filter_name or 'html']))
+            pos = match.end()
+        parts.append(source[pos:].encode('utf-8'))
+        self.parts = tuple(parts)
+
+    def render(self, **values):
+        """Yield the rendered template as bytes chunks. A slot value may be
+        either a string or an iterable of strings, the latter of which will be
+        escaped and yielded chunk by chunk.
+        """
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            name, _filter = part
+            value = values[name]
+            if isinstance(value, str):
+                yield _filter(value).encode('utf-8')
+            else:
+                for chunk in value:
+                    yield _filter(chunk).encode('utf-8')
+
+def iter_file_text(fs_path):
+    """Yield the decoded contents of a UTF-8 file in chunks.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open(fs_path, 'rb') as fh:
+        while True:
+            data = fh.read(FILE_CHUNK_BYTES)
+            if not data:
+                break
+            yield decoder.decode(data)
+    yield decoder.decode(b'', final=True)
+
+def count_file_lines(fs_path):
+    """Return the number of lines in a UTF-8 file, raising UnicodeDecodeError
+    if it can't be decoded so that the error occurs before the response is
+    sent, rather than while the decoded contents are being streamed.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    num_lines = 1
+    with open(fs_path, 'rb') as fh:
+        while True:
+            data = fh.read(FILE_CHUNK_BYTES)
+            if not data:
+                decoder.decode(b'', final=True)
+                return num_lines
+            decoder.decode(data)
+            num_lines += data.count(b'\n')
 
 ###############################################################################
 # Text File Editor
 ###############################################################################
 
-def TextFileEditor(req_path, text):
-    filename = path.split(req_path)[-1]
-    script = Script(
-"""
-document.addEventListener('DOMContentLoaded', () => {{
+TEXT_FILE_EDITOR_TEMPLATE = Template(
+"""<!DOCTYPE html>
+<html>
+<head>
+<script>
+document.addEventListener('DOMContentLoaded', () => {
   const inputEl = document.getElementById('textarea')
   const buttonEl = document.getElementById('submit')
 
-  function submit () {{
-    fetch(new URL("/_fs/{req_path}", window.location.href), {{
+  function submit () {
+    fetch(new URL({{url|js}}, window.location.href), {
       method: 'PUT',
-      headers: {{
+      headers: {
         'Content-Type': 'text/plain',
-      }},
+      },
       redirect: 'follow',
-      body: new File([inputEl.value], "{filename}")
-    }})
-    .then(response => {{
-      if (response.redirected) {{
+      body: new File([inputEl.value], {{filename|js}})
+    })
+    .then(response => {
+      if (response.redirected) {
         window.location = response.url
-      }}
-    }})
+      }
+    })
     .catch(error => console.error('Error:', error));
-  }}
+  }
    buttonEl.addEventListener('click', () => submit())
-   inputEl.addEventListener('keydown', e => {{
+   inputEl.addEventListener('keydown', e => {
     if (e.ctrlKey && e.key === "Enter") submit()
-  }})
-}})
-""".format(req_path=req_path, filename=filename)
-    )
+  })
+})
+</script>
+</head>
+<body>
+<textarea rows="{{rows}}" style="width: 100%;" id="textarea">
+{{text}}</textarea>
+<button id="submit">submit</button>
+</body>
+</html>
+""")
 
-    return DocumentStream(
-        body_els=(
-            Textarea(text, rows=text.count('\n') + 1, style='width: 100%;',
-                     id='textarea'),
-            Button('submit', id='submit')
-        ),
-        head_els=(script,)
-    )
+def TextFileEditor(req_path, fs_path=None):
+    """Return a file-type stream of an editor page for the file at fs_path, or
+    for a new, empty file if fs_path is None.
+    """
+    filename = path.split(req_path)[-1]
+    if fs_path is None:
+        text, rows = '', 1
+    else:
+        text, rows = iter_file_text(fs_path), count_file_lines(fs_path)
+    return ChunkStream(TEXT_FILE_EDITOR_TEMPLATE.render(
+        url='/_fs/{}'.format(req_path),
+        filename=filename,
+        rows=str(rows),
+        text=text,
+    ))
 
 ###############################################################################
 # Filesystem Directory Listing
 ###############################################################################
 
-def _directory_listing_item(fs_path, href_prefix, filename):
-    _fs_path = path.join(fs_path, filename)
-    is_dir = path.isdir(_fs_path)
-    href_suffix = '{}/'.format(filename) if is_dir else filename
-    container = Div()
-    # Add either a directory spacer or edit link.
-    if is_dir:
-        container.children.append(Span('----', style="margin-right: 1rem;"))
+DIRECTORY_LISTING_HEADER_TEMPLATE = Template(
+"""<!DOCTYPE html>
+<html>
+<head>
+<style>body {font-family: monospace; font-size: 1rem;}</style>
+</head>
+<body>
+<form method="post" enctype="multipart/form-data">\
+<input type="file" name="files" multiple> <button type="submit">upload</button>\
+</form>
+""")
+
+DIRECTORY_LISTING_DIRECTORY_ITEM_TEMPLATE = Template(
+"""<div><span style="margin-right: 1rem;">----</span>\
+<a href="{{href}}" style="text-decoration: none; margin-right: 1rem;">\
+{{name}}</a></div>
+""")
+
+DIRECTORY_LISTING_FILE_ITEM_TEMPLATE = Template(
+"""<div><a href="{{href}}?edit=1" \
+style="text-decoration: none; margin-right: 1rem;">edit</a>\
+<a href="{{href}}" style="text-decoration: none; margin-right: 1rem;">\
+{{name}}</a></div>
+""")
+
+DIRECTORY_LISTING_FOOTER_TEMPLATE = Template(
+"""</body>
+</html>
+""")
+
+def _directory_listing_item(entry, href_prefix):
+    if entry.is_dir():
+        href_suffix = '{}/'.format(entry.name)
+        template = DIRECTORY_LISTING_DIRECTORY_ITEM_TEMPLATE
     else:
-        container.children.append(Anchor(
-            'edit',
-            href=href_prefix + href_suffix + '?edit=1',
-            style='text-decoration: none; margin-right: 1rem;'
-        ))
-    # Add the item link.
-    container.children.append(Anchor(
-        href_suffix,
-        href=href_prefix + href_suffix,
-        style='text-decoration: none; margin-right: 1rem;'
-    ))
-    return container
+        href_suffix = entry.name
+        template = DIRECTORY_LISTING_FILE_ITEM_TEMPLATE
+    return template.render(href=href_prefix + href_suffix, name=href_suffix)
+
+def _directory_listing(fs_path, href_prefix):
+    yield from DIRECTORY_LISTING_HEADER_TEMPLATE.render()
+    with os.scandir(fs_path) as entries:
+        for entry in entries:
+            yield from _directory_listing_item(entry, href_prefix)
+    yield from DIRECTORY_LISTING_FOOTER_TEMPLATE.render()
 
 def FilesystemDirectoryListing(fs_path, req_path):
-    """Return a directory listing HTML page for the specified req_path.
+    """Return a file-type stream of a directory listing HTML page for the
+    specified req_path.
     """
     href_prefix = '/_fs{}/'.format(
         ('/' + req_path.rstrip('/')) if req_path else ''
     )
-    return DocumentStream(
-        body_els=[_directory_listing_item(fs_path, href_prefix, filename)
-                  for filename in os.listdir(fs_path)],
-        head_els=[Style('body {font-family: monospace; font-size: 1rem;}')]
-    )
+    return ChunkStream(_directory_listing(fs_path, href_prefix))
@@ -0,0 +1,340 @@
+"""Streaming multipart/form-data request body parsing.
+"""
+import tempfile
+from collections import namedtuple
+
+from .server import (
+    CRLF,
+    MULTIPART_FORM_DATA,
+    TEXT_PLAIN,
+    CouldNotParse,
+    PayloadTooLarge,
+    _400,
+    _413,
+    _decode,
+    read_body,
+)
+
+###############################################################################
+# Constants
+###############################################################################
+
+# The max number of bytes to read from the request body at a time.
+READ_CHUNK_BYTES = 16384
+
+# The max size of the header block of a single part.
+MAX_PART_HEADER_BYTES = 8192
+
+# Default limits, where None means unlimited.
+DEFAULT_MAX_PART_BYTES = 16 * 1024 * 1024
+DEFAULT_MAX_TOTAL_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_FIELD_BYTES = 65536
+
+# The size above which a file part will be spooled to disk.
+DEFAULT_SPOOL_THRESHOLD = 65536
+
+###############################################################################
+# Types
+###############################################################################
+
+UploadedFile = namedtuple('UploadedFile', (
+    'name',
+    'filename',
+    'content_type',
+    'headers',
+    'file',
+))
+
+class Form:
+    """The parsed fields and files of a multipart/form-data request, where
+    fields maps names to lists of string values and files maps names to lists
+    of UploadedFile.
+    """
+    def __init__(self):
+        self.fields = {}
+        self.files = {}
+
+    def close(self):
+        for uploaded_files in self.files.values():
+            for uploaded_file in uploaded_files:
+                uploaded_file.file.close()
+
+###############################################################################
+# Parsing
+###############################################################################
+
+def parse_options_header(value):
+    """Parse a header value like 'form-data; name="a"; filename="b.txt"' into a
+    ('form-data', {'name': 'a', 'filename': 'b.txt'}) tuple.
+    """
+    value, _, rest = value.partition(';')
+    params = {}
+    while rest:
+        k, _, rest = rest.partition('=')
+        k = k.strip().lower()
+        rest = rest.lstrip()
+        if rest.startswith('"'):
+            # Read a quoted string, unescaping any backslash-escaped chars.
+            chars = []
+            i = 1
+            while i < len(rest) and rest[i] != '"':
+                if rest[i] == '\\' and i + 1 < len(rest):
+                    i += 1
+                chars.append(rest[i])
+                i += 1
+            v = ''.join(chars)
+            rest = rest[i + 1:].partition(';')[2]
+        else:
+            v, _, rest = rest.partition(';')
+            v = v.strip()
+        if k:
+            params[k] = v
+    return value.strip().lower(), params
+
+class Part:
+    """A single part of a multipart body, which is an async iterator of its
+    body bytes chunks.
+    """
+    def __init__(self, parser, headers):
+        self.parser = parser
+        self.headers = headers
+        _, params = parse_options_header(
+            headers.get('content-disposition', '')
+        )
+        self.name = params.get('name')
+        self.filename = params.get('filename')
+        self.content_type = headers.get('content-type', TEXT_PLAIN)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.parser.read_part_chunk(self)
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
+
+    async def read(self, max_bytes=None):
+        """Return the whole part body, raising PayloadTooLarge if it exceeds
+        max_bytes.
+        """
+        chunks = []
+        num_bytes = 0
+        async for chunk in self:
+            num_bytes += len(chunk)
+            if max_bytes is not None and num_bytes > max_bytes:
+                raise PayloadTooLarge('Part exceeds {} bytes'.format(max_bytes))
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    async def spool(self, threshold=DEFAULT_SPOOL_THRESHOLD):
+        """Return the part body as a rewound file that is held in memory up to
+        threshold bytes and on disk thereafter.
+        """
+        fh = tempfile.SpooledTemporaryFile(max_size=threshold)
+        try:
+            async for chunk in self:
+                fh.write(chunk)
+        except BaseException:
+            fh.close()
+            raise
+        fh.seek(0)
+        return fh
+
+class MultipartParser:
+    """An incremental parser of a multipart/form-data request body that holds
+    at most about one read chunk of the body in memory at a time.
+    """
+    def __init__(self, request, max_part_bytes=DEFAULT_MAX_PART_BYTES,
+                 max_total_bytes=DEFAULT_MAX_TOTAL_BYTES):
+        content_type, params = parse_options_header(
+            request.headers.get('content-type', '')
+        )
+        if content_type != MULTIPART_FORM_DATA or not params.get('boundary'):
+            raise CouldNotParse(
+                'Expected Content-Type: {} with a boundary'.format(
+                    MULTIPART_FORM_DATA
+                )
+            )
+        content_length = int(request.headers.get('content-length') or 0)
+        if max_total_bytes is not None and content_length > max_total_bytes:
+            raise PayloadTooLarge(
+                'Body exceeds {} bytes'.format(max_total_bytes)
+            )
+        self.max_part_bytes = max_part_bytes
+        self.delimiter = CRLF + b'--' + params['boundary'].encode('latin-1')
+        self.chunks = read_body(request, READ_CHUNK_BYTES)
+        # Prefix the body with a CRLF so that the first delimiter can be
+        # matched like any other.
+        self.buf = bytearray(CRLF)
+        self.started = False
+        self.done = False
+        self.part = None
+        self.part_done = True
+        self.part_bytes = 0
+
+    async def _fill(self):
+        """Append the next body chunk to the buffer, raising CouldNotParse if
+        the body has been exhausted.
+        """
+        try:
+            self.buf += await self.chunks.__anext__()
+        except StopAsyncIteration:
+            raise CouldNotParse('Unexpected end of multipart body')
+
+    async def next_part(self):
+        """Return the next Part, or None if there are no more. Any unread body
+        of the current part is skipped.
+        """
+        if self.part is not None:
+            while await self.read_part_chunk(self.part) is not None:
+                pass
+        if self.done:
+            return None
+        buf = self.buf
+        delimiter = self.delimiter
+
+        if not self.started:
+            # Skip any preamble up to and including the first delimiter.
+            while True:
+                i = buf.find(delimiter)
+                if i != -1:
+                    del buf[:i + len(delimiter)]
+                    break
+                del buf[:max(len(buf) - len(delimiter) + 1, 0)]
+                await self._fill()
+            self.started = True
+
+        # A delimiter is followed by either "--", signaling the end of the
+        # body, or a CRLF and the part headers.
+        while len(buf) < 2:
+            await self._fill()
+        if buf[:2] == b'--':
+            self.done = True
+            self.part = None
+            return None
+        if buf[:2] != CRLF:
+            raise CouldNotParse('Malformed multipart delimiter')
+        del buf[:2]
+
+        while True:
+            if buf[:2] == CRLF:
+                # The part has no headers.
+                header_lines = []
+                del buf[:2]
+                break
+            i = buf.find(CRLF + CRLF)
+            if i != -1:
+                header_lines = bytes(buf[:i]).split(CRLF)
+                del buf[:i + 4]
+                break
+            if len(buf) > MAX_PART_HEADER_BYTES:
+                raise CouldNotParse('Multipart part headers are too large')
+            await self._fill()
+
+        headers = {}
+        for line in header_lines:
+            k, sep, v = _decode(line).partition(':')
+            if not sep:
+                raise CouldNotParse('Malformed multipart part header')
+            headers[k.strip().lower()] = v.strip()
+
+        self.part = Part(self, headers)
+        self.part_done = False
+        self.part_bytes = 0
+        return self.part
+
+    async def read_part_chunk(self, part):
+        """Return the next body chunk of part, or None if it has been read.
+        """
+        if part is not self.part or self.part_done:
+            return None
+        buf = self.buf
+        delimiter = self.delimiter
+        while True:
+            i = buf.find(delimiter)
+            if i != -1:
+                chunk = bytes(buf[:i])
+                del buf[:i + len(delimiter)]
+                self.part_done = True
+                break
+            # Return everything that can't be the start of a delimiter.
+            n = len(buf) - len(delimiter) + 1
+            if n > 0:
+                chunk = bytes(buf[:n])
+                del buf[:n]
+                break
+            await self._fill()
+        self.part_bytes += len(chunk)
+        if (self.max_part_bytes is not None and
+            self.part_bytes > self.max_part_bytes):
+            raise PayloadTooLarge(
+                'Part exceeds {} bytes'.format(self.max_part_bytes)
+            )
+        return chunk or None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        part = await self.next_part()
+        if part is None:
+            raise StopAsyncIteration
+        return part
+
+async def parse_form(request, spool_threshold=DEFAULT_SPOOL_THRESHOLD,
+                     max_part_bytes=DEFAULT_MAX_PART_BYTES,
+                     max_total_bytes=DEFAULT_MAX_TOTAL_BYTES,
+                     max_field_bytes=DEFAULT_MAX_FIELD_BYTES):
+    """Parse a multipart/form-data request into a Form, spooling file parts
+    larger than spool_threshold to disk.
+    """
+    form = Form()
+    try:
+        async for part in MultipartParser(request, max_part_bytes,
+                                          max_total_bytes):
+            if part.filename is None:
+                value = (await part.read(max_field_bytes)).decode('utf-8')
+                form.fields.setdefault(part.name, []).append(value)
+            else:
+                form.files.setdefault(part.name, []).append(UploadedFile(
+                    name=part.name,
+                    filename=part.filename,
+                    content_type=part.content_type,
+                    headers=part.headers,
+                    file=await part.spool(spool_threshold),
+                ))
+    except BaseException:
+        form.close()
+        raise
+    return form
+
+###############################################################################
+# Request Handler Decorators
+###############################################################################
+
+def multipart_request(spool_threshold=DEFAULT_SPOOL_THRESHOLD,
+                      max_part_bytes=DEFAULT_MAX_PART_BYTES,
+                      max_total_bytes=DEFAULT_MAX_TOTAL_BYTES,
+                      max_field_bytes=DEFAULT_MAX_FIELD_BYTES):
+    """A request handler decorator that parses a multipart/form-data request
+    body and passes the resulting Form as an argument to the handler.
+    """
+    def decorator(func):
+        async def wrapper(request, *args, **kwargs):
+            try:
+                form = await parse_form(request, spool_threshold,
+                                        max_part_bytes, max_total_bytes,
+                                        max_field_bytes)
+            except CouldNotParse as e:
+                return _400(str(e))
+            except PayloadTooLarge as e:
+                return _413(str(e))
+            except UnicodeDecodeError:
+                return _400('Could not decode form field as UTF-8')
+            try:
+                return await func(request, form, *args, **kwargs)
+            finally:
+                form.close()
+        return wrapper
+    return decorator
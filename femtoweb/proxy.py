@@ -0,0 +1,465 @@
+"""Reverse proxying of requests to upstream HTTP servers.
+"""
+import asyncio
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+from .server import (
+    CRLF,
+    DELETE,
+    GET,
+    POST,
+    PUT,
+    HTTPServerException,
+    _400,
+    _502,
+    _503,
+    _504,
+    _close,
+    _decode,
+    drain,
+    read_body,
+    route,
+    with_timeout,
+)
+
+###############################################################################
+# Constants
+###############################################################################
+
+PROXY_METHODS = (DELETE, GET, 'HEAD', 'OPTIONS', 'PATCH', POST, PUT)
+
+# The methods of requests that can safely be retried, since the upstream may
+# have processed a request before its connection failed.
+IDEMPOTENT_METHODS = frozenset((DELETE, GET, 'HEAD', 'OPTIONS', PUT))
+
+# The max number of bytes to read from a request or response body at a time.
+PROXY_CHUNK_BYTES = 65536
+
+# The max number of open connections per upstream, the number of seconds for
+# which to retain each idle connection, and the max number of seconds to wait
+# for a connection when all of them are in use.
+DEFAULT_POOL_MAX_SIZE = 8
+DEFAULT_POOL_IDLE_TTL_SECONDS = 30
+DEFAULT_POOL_TIMEOUT_SECONDS = 10
+
+UPSTREAM_CONNECT_TIMEOUT_SECONDS = 5
+UPSTREAM_READ_TIMEOUT_SECONDS = 30
+
+# Headers that only apply to a single connection and so must not be
+# forwarded.
+HOP_BY_HOP_HEADERS = frozenset((
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'te',
+    'trailer',
+    'transfer-encoding',
+    'upgrade',
+))
+
+# Request headers that the proxy sets itself.
+REPLACED_REQUEST_HEADERS = frozenset((
+    'expect',
+    'host',
+    'x-forwarded-for',
+    'x-forwarded-host',
+    'x-forwarded-proto',
+))
+
+###############################################################################
+# Exceptions
+###############################################################################
+
+class UpstreamError(HTTPServerException): pass
+class UpstreamTimeout(UpstreamError): pass
+class PoolTimeout(UpstreamError): pass
+
+###############################################################################
+# Connection Pool
+###############################################################################
+
+class UpstreamConnection:
+    __slots__ = ('reader', 'writer', 'loop', 'idle_since')
+
+    def __init__(self, reader, writer, loop):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.idle_since = None
+
+    def is_usable(self, loop):
+        """Return a bool indicating whether the connection belongs to loop and
+        has not been closed or broken.
+        """
+        return (
+            self.loop is loop and
+            not self.writer.is_closing() and
+            not self.reader.at_eof() and
+            self.reader.exception() is None
+        )
+
+    def close(self):
+        # A connection can't be closed once its loop has been.
+        if not self.loop.is_closed():
+            self.writer.close()
+
+class UpstreamPool:
+    """A pool of keep-alive connections to an upstream server that has at most
+    max_size connections open at a time, and retains each idle connection for
+    at most idle_ttl seconds. acquire() waits up to timeout seconds for a
+    connection when all of them are in use.
+    """
+    def __init__(self, host, port, max_size=DEFAULT_POOL_MAX_SIZE,
+                 idle_ttl=DEFAULT_POOL_IDLE_TTL_SECONDS,
+                 connect_timeout=UPSTREAM_CONNECT_TIMEOUT_SECONDS,
+                 timeout=DEFAULT_POOL_TIMEOUT_SECONDS):
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        # A semaphore that's held for each in-use connection, which is created
+        # for the loop in which the pool is used.
+        self.loop = None
+        self.semaphore = None
+        self.active = 0
+        # Idle connections, ordered from least to most recently used.
+        self.idle = deque()
+        self.opened = 0
+        self.reused = 0
+        self.evicted = 0
+
+    def _evict(self, conn):
+        self.evicted += 1
+        conn.close()
+
+    def _prune(self, now):
+        # Evict the connections that have outlived the idle TTL, all of which
+        # are at the least recently used end.
+        idle = self.idle
+        while idle and now - idle[0].idle_since > self.idle_ttl:
+            self._evict(idle.popleft())
+
+    async def acquire(self):
+        """Return a (connection, reused) tuple, preferring the most recently
+        used healthy idle connection to opening a new one, and raising
+        PoolTimeout if no connection becomes available within the timeout.
+        Every acquired connection must be passed to release().
+        """
+        loop = asyncio.get_event_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.semaphore = asyncio.Semaphore(self.max_size)
+        await with_timeout(self.semaphore.acquire(), self.timeout,
+                           PoolTimeout)
+        self.active += 1
+        try:
+            return await self._acquire(loop)
+        except BaseException:
+            self.active -= 1
+            self.semaphore.release()
+            raise
+
+    async def _acquire(self, loop):
+        self._prune(time.monotonic())
+        while self.idle:
+            conn = self.idle.pop()
+            if conn.is_usable(loop):
+                self.reused += 1
+                return conn, True
+            self._evict(conn)
+        try:
+            reader, writer = await with_timeout(
+                asyncio.open_connection(self.host, self.port),
+                self.connect_timeout,
+                UpstreamTimeout
+            )
+        except OSError as e:
+            raise UpstreamError('Could not connect to upstream: {}'.format(e))
+        self.opened += 1
+        return UpstreamConnection(reader, writer, loop), False
+
+    def release(self, conn, reusable):
+        """Return the connection to the pool if reusable is True, otherwise
+        close it.
+        """
+        if reusable and conn.is_usable(conn.loop):
+            conn.idle_since = time.monotonic()
+            self.idle.append(conn)
+        else:
+            conn.close()
+        if conn.loop is self.loop:
+            self.active -= 1
+            self.semaphore.release()
+
+    def clear(self):
+        """Close all idle connections, e.g. because one of them was found to
+        be broken.
+        """
+        while self.idle:
+            self._evict(self.idle.pop())
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'idle': len(self.idle),
+            'opened': self.opened,
+            'reused': self.reused,
+            'evicted': self.evicted,
+        }
+
+###############################################################################
+# Proxying
+###############################################################################
+
+def _connection_tokens(value):
+    return {token.strip().lower() for token in value.split(',')}
+
+def encode_request_head(request, target, netloc):
+    """Return the head of the request to forward to the upstream, replacing
+    the hop-by-hop headers and adding the X-Forwarded-* headers.
+    """
+    excluded = (
+        HOP_BY_HOP_HEADERS |
+        REPLACED_REQUEST_HEADERS |
+        _connection_tokens(request.headers.get('connection', ''))
+    )
+    lines = [
+        '{} {} HTTP/1.1'.format(request.method, target),
+        'host: {}'.format(netloc),
+    ]
+    for k, v in request.headers.items():
+        if k not in excluded:
+            lines.append('{}: {}'.format(k, v))
+
+    forwarded_for = request.headers.get('x-forwarded-for')
+    peername = request.writer.get_extra_info('peername')
+    if isinstance(peername, tuple):
+        forwarded_for = ', '.join(filter(None, (forwarded_for, peername[0])))
+    if forwarded_for:
+        lines.append('x-forwarded-for: {}'.format(forwarded_for))
+    if 'host' in request.headers:
+        lines.append('x-forwarded-host: {}'.format(request.headers['host']))
+    lines.append('x-forwarded-proto: http')
+    lines.append('')
+    lines.append('')
+    return '\r\n'.join(lines).encode('ISO-8859-1')
+
+async def _read_line(reader, timeout):
+    """Return the next line from the upstream reader, including its CRLF.
+    """
+    try:
+        return await with_timeout(
+            reader.readuntil(CRLF), timeout, UpstreamTimeout
+        )
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        raise UpstreamError('Upstream sent a short or malformed line')
+
+async def read_response_head(reader, timeout):
+    """Return a (status_line, header_lines) tuple of bytes for the next final
+    (i.e. non-1xx) upstream response.
+    """
+    while True:
+        try:
+            head = await with_timeout(
+                reader.readuntil(CRLF + CRLF), timeout, UpstreamTimeout
+            )
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            raise UpstreamError('Upstream sent a short or malformed response')
+        status_line, *header_lines = head[:-4].split(CRLF)
+        try:
+            status = int(status_line.split(b' ', 2)[1])
+        except (IndexError, ValueError):
+            raise UpstreamError('Malformed upstream status line')
+        # Skip any informational responses.
+        if not 100 <= status < 200:
+            return status_line, header_lines
+
+async def _copy(reader, writer, num_bytes, timeout):
+    """Forward num_bytes from the upstream reader to the client writer.
+    """
+    while num_bytes > 0:
+        chunk = await with_timeout(
+            reader.read(min(num_bytes, PROXY_CHUNK_BYTES)),
+            timeout,
+            UpstreamTimeout
+        )
+        if not chunk:
+            raise UpstreamError('Upstream closed the connection mid-response')
+        num_bytes -= len(chunk)
+        writer.write(chunk)
+        await drain(writer)
+
+async def _copy_chunked(reader, writer, timeout):
+    """Forward a chunked body, as is, from the upstream reader to the client
+    writer.
+    """
+    while True:
+        line = await _read_line(reader, timeout)
+        writer.write(line)
+        try:
+            size = int(line.split(b';', 1)[0], 16)
+        except ValueError:
+            raise UpstreamError('Malformed upstream chunk size')
+        if size == 0:
+            break
+        # Forward the chunk data and its trailing CRLF.
+        await _copy(reader, writer, size + 2, timeout)
+    # Forward any trailers and the terminating empty line.
+    while line != CRLF:
+        line = await _read_line(reader, timeout)
+        writer.write(line)
+    await drain(writer)
+
+async def _copy_until_eof(reader, writer, timeout):
+    while True:
+        chunk = await with_timeout(
+            reader.read(PROXY_CHUNK_BYTES), timeout, UpstreamTimeout
+        )
+        if not chunk:
+            return
+        writer.write(chunk)
+        await drain(writer)
+
+async def forward_response(request, conn, status_line, header_lines, timeout):
+    """Stream the upstream response to the client and return a bool
+    indicating whether the upstream connection can be reused.
+    """
+    version, status = status_line.split(b' ', 2)[:2]
+    status = int(status)
+    keep_alive = version == b'HTTP/1.1'
+    content_length = None
+    chunked = False
+    head = [status_line]
+    for line in header_lines:
+        k, _, v = line.partition(b':')
+        k = _decode(k).strip().lower()
+        if k == 'connection':
+            keep_alive &= 'close' not in _connection_tokens(_decode(v))
+        elif k == 'transfer-encoding':
+            chunked = 'chunked' in _connection_tokens(_decode(v))
+        elif k == 'content-length':
+            try:
+                content_length = int(v)
+            except ValueError:
+                raise UpstreamError('Malformed upstream content-length')
+        if k not in HOP_BY_HOP_HEADERS:
+            head.append(line)
+    if chunked:
+        head.append(b'transfer-encoding: chunked')
+    head.append(b'connection: close')
+    head.append(CRLF)
+
+    writer = request.writer
+    writer.write(CRLF.join(head))
+    await drain(writer)
+    if request.method == 'HEAD' or status in (204, 304):
+        pass
+    elif chunked:
+        await _copy_chunked(conn.reader, writer, timeout)
+    elif content_length is not None:
+        await _copy(conn.reader, writer, content_length, timeout)
+    else:
+        # The body is delimited by the upstream closing the connection.
+        await _copy_until_eof(conn.reader, writer, timeout)
+        keep_alive = False
+    return keep_alive
+
+async def _send_request(request, conn, head, timeout):
+    """Write the request head and stream any body to the upstream, and
+    return the response (status_line, header_lines).
+    """
+    conn.writer.write(head)
+    async for chunk in read_body(request, PROXY_CHUNK_BYTES):
+        conn.writer.write(chunk)
+        await with_timeout(conn.writer.drain(), timeout, UpstreamTimeout)
+    await with_timeout(conn.writer.drain(), timeout, UpstreamTimeout)
+    return await read_response_head(conn.reader, timeout)
+
+async def proxy_request(request, pool, target_prefix, netloc,
+                        timeout=UPSTREAM_READ_TIMEOUT_SECONDS):
+    """Forward the request to the upstream of pool and stream its response
+    back to the client, returning an error response if the upstream fails
+    before it has responded.
+    """
+    if 'transfer-encoding' in request.headers:
+        return _400('Chunked request bodies are not supported')
+    head = encode_request_head(request, target_prefix + request.url, netloc)
+    has_body = int(request.headers.get('content-length') or 0) > 0
+    if has_body and request.headers.get('expect') == '100-continue':
+        request.writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        await drain(request.writer)
+
+    while True:
+        try:
+            conn, reused = await pool.acquire()
+        except PoolTimeout:
+            return _503('No upstream connection is available')
+        except UpstreamTimeout:
+            return _504()
+        except UpstreamError as e:
+            return _502(str(e))
+        reusable = False
+        try:
+            try:
+                status_line, header_lines = await _send_request(
+                    request, conn, head, timeout
+                )
+            except (OSError, UpstreamError) as e:
+                # Assume that any other idle connections are also broken.
+                pool.clear()
+                if (reused and not has_body and
+                    request.method in IDEMPOTENT_METHODS and
+                    not isinstance(e, UpstreamTimeout)):
+                    # The upstream probably closed the idle connection, so
+                    # retry with a new one.
+                    continue
+                if isinstance(e, UpstreamTimeout):
+                    return _504()
+                return _502(str(e) or 'Upstream connection failed')
+            try:
+                reusable = await forward_response(
+                    request, conn, status_line, header_lines, timeout
+                )
+            except (OSError, UpstreamError):
+                # The response has already started, so the only way to signal
+                # the failure is to drop the client.
+                pool.clear()
+                request.writer.transport.abort()
+                return
+        finally:
+            pool.release(conn, reusable)
+        break
+
+    await _close(request.writer)
+
+def proxy_route(path_pattern, upstream, methods=PROXY_METHODS,
+                max_size=DEFAULT_POOL_MAX_SIZE,
+                idle_ttl=DEFAULT_POOL_IDLE_TTL_SECONDS,
+                timeout=UPSTREAM_READ_TIMEOUT_SECONDS, rate_limit=None,
+                pool_timeout=DEFAULT_POOL_TIMEOUT_SECONDS):
+    """Register a route that forwards requests for path_pattern to the
+    upstream base URL, e.g. 'http://127.0.0.1:9000' or
+    'http://127.0.0.1:9000/prefix', optionally limited by a RateLimiter, and
+    return its UpstreamPool.
+    """
+    parts = urlsplit(upstream)
+    if parts.scheme != 'http' or not parts.hostname:
+        raise ValueError(
+            'Expected an http://<host>[:<port>][/<path>] upstream, got: {}'
+            .format(upstream)
+        )
+    pool = UpstreamPool(parts.hostname, parts.port or 80, max_size, idle_ttl,
+                        timeout=pool_timeout)
+    target_prefix = parts.path.rstrip('/')
+
+    @route(path_pattern, methods=methods, rate_limit=rate_limit)
+    async def proxy(request):
+        return await proxy_request(request, pool, target_prefix, parts.netloc,
+                                   timeout)
+
+    return pool
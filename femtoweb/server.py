@@ -1,10 +1,31 @@
 
 import asyncio
+import contextvars
 import json
+import math
+import os
+import queue
+import random
 import re
+import socket
+import stat
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 from traceback import print_exc
 
-from collections import namedtuple
+from collections import (
+    OrderedDict,
+    namedtuple,
+)
+from contextlib import nullcontext
+from urllib.parse import unquote_plus
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 
 ###############################################################################
@@ -27,8 +48,12 @@ class Headers:
     built-in HTTPResponse.headers.
     See: https://docs.python.org/3/library/email.message.html#email.message.EmailMessage
     """
+    __slots__ = ('headers',)
+
     def __init__(self, headers=None):
-        if headers is not None:
+        if headers is None:
+            self.headers = []
+        else:
             self.headers = (
                 list(headers.items()) if isinstance(headers, dict) else headers
             )
@@ -107,51 +132,236 @@ class Headers:
         # Not implemented by EmailMessage.
         yield from self.headers
 
+class Query:
+    """A multi-valued map of URL query params that defers parsing of the query
+    string until the params are first accessed.
+    """
+    __slots__ = ('query_string', '_params')
+
+    def __init__(self, query_string=''):
+        self.query_string = query_string
+        self._params = None
+
+    @property
+    def params(self):
+        # Map param names to the list of their values, in request order.
+        if self._params is None:
+            self._params = parse_query_string(self.query_string)
+        return self._params
+
+    def __repr__(self):
+        return repr(self.params)
+
+    def __len__(self):
+        return len(self.params)
+
+    def __contains__(self, k):
+        return k in self.params
+
+    def __getitem__(self, k):
+        # Return the last value, consistent with repeated dict assignment.
+        return self.params[k][-1]
+
+    def __iter__(self):
+        return iter(self.params)
+
+    def keys(self):
+        return list(self.params)
+
+    def get(self, k, default=None):
+        vals = self.params.get(k)
+        return default if vals is None else vals[-1]
+
+    def get_all(self, k, default=None):
+        return self.params.get(k, default)
+
+    def items(self):
+        for k, vals in self.params.items():
+            for v in vals:
+                yield k, v
+
+class ChunkStream:
+    """A file-type wrapper around an iterable of bytes chunks that allows a
+    lazily-generated body to be sent by send() like any other file.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = b''
+
+    def readinto(self, buf):
+        num_bytes = 0
+        buf_len = len(buf)
+        while num_bytes < buf_len:
+            if not self.pending:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                self.pending = memoryview(chunk)
+                continue
+            n = min(len(self.pending), buf_len - num_bytes)
+            buf[num_bytes:num_bytes + n] = self.pending[:n]
+            self.pending = self.pending[n:]
+            num_bytes += n
+        return num_bytes
+
+    def close(self):
+        close = getattr(self.chunks, 'close', None)
+        if close is not None:
+            close()
+
 DEFAULT_RESPONSE_HEADERS = {
     'content-type': 'text/html',
     'connection': 'close',
 }
 
+# Map (<response-class>, <cors-enabled>) tuples to the tuple of default header
+# items for responses of that class.
+_default_header_items_cache = {}
+
+# Map (<response-class>, <status_int>, <cors-enabled>) tuples to the encoded
+# status line and headers for responses that use the default headers.
+_encoded_heads = {}
+
+def _merge_header_items(items, headers):
+    """Return a list of header items with headers merged into items, replacing
+    the values of any existing header names.
+    """
+    merged = Headers(list(items))
+    for k, v in headers.items():
+        if k in merged:
+            merged.replace_header(k, v)
+        else:
+            merged[k] = v
+    return merged.headers
+
+def encode_head(status_int, header_items):
+    """Return the encoded status line and headers of a response.
+    """
+    lines = ['HTTP/1.1 {} OK\n'.format(status_int)]
+    lines.extend('{}: {}\n'.format(k, v) for k, v in header_items)
+    lines.append('\n')
+    return ''.join(lines).encode()
+
 class Response():
+    __slots__ = ('status_int', '_headers', 'body', 'background')
+
     CORS_ENABLED = True
 
+    # Subclasses can specify a dict of headers to apply to all of their
+    # responses.
+    default_headers = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Support the older style of specifying default headers as a class
+        # attribute named "headers", which would otherwise shadow the headers
+        # property.
+        headers = cls.__dict__.get('headers')
+        if isinstance(headers, dict):
+            del cls.headers
+            cls.default_headers = headers
+        # A class attribute named "body" would shadow the body slot and make
+        # it read-only.
+        if 'body' in cls.__dict__:
+            raise TypeError(
+                '{} must not define a class attribute named "body"'.format(
+                    cls.__name__
+                )
+            )
+
     def __init__(self, status_int=None, headers=None, body=None):
         if status_int is not None:
             self.status_int = status_int
-
-        # Init a default Headers object.
-        _headers = Headers(DEFAULT_RESPONSE_HEADERS)
-
-        if self.CORS_ENABLED:
-            _headers['access-control-allow-origin'] = '*'
-
-        # Set any subclass-specified headers.
-        if hasattr(self, 'headers'):
-            for k, v in self.headers.items():
-                if k in _headers:
-                    _headers.replace_header(k, v)
-                else:
-                    _headers[k] = v
-
-        # Set any argument-specified headers.
-        if headers is not None:
-            for k, v in headers.items():
-                if k in _headers:
-                    _headers.replace_header(k, v)
-                else:
-                    _headers[k] = v
-
-        self.headers = _headers
+        # Only materialize a Headers object if argument-specified headers
+        # need to be merged with the shared defaults, or if the headers are
+        # later accessed via the headers property.
+        self._headers = (
+            None if headers is None
+            else Headers(_merge_header_items(self._default_header_items(),
+                                             headers))
+        )
         self.body = body
+        # A list of (<func>, <args>, <kwargs>) tuples to submit to the
+        # background task queue once the response has been sent.
+        self.background = None
+
+    @classmethod
+    def _default_header_items(cls):
+        key = (cls, cls.CORS_ENABLED)
+        items = _default_header_items_cache.get(key)
+        if items is None:
+            items = list(DEFAULT_RESPONSE_HEADERS.items())
+            if cls.CORS_ENABLED:
+                items.append(('access-control-allow-origin', '*'))
+            if cls.default_headers is not None:
+                items = _merge_header_items(items, cls.default_headers)
+            items = _default_header_items_cache[key] = tuple(items)
+        return items
+
+    @property
+    def headers(self):
+        # Copy the shared default headers on first access.
+        if self._headers is None:
+            self._headers = Headers(list(self._default_header_items()))
+        return self._headers
+
+    @headers.setter
+    def headers(self, headers):
+        self._headers = headers
+
+    def add_background_task(self, func, *args, **kwargs):
+        """Schedule the coroutine function func to be called with the specified
+        arguments by the background task queue after the response is sent.
+        """
+        if self.background is None:
+            self.background = []
+        self.background.append((func, args, kwargs))
+
+    def encode_head(self):
+        """Return the encoded status line and headers, which are shared by all
+        responses of the same class and status that use the default headers.
+        """
+        if self._headers is not None:
+            return encode_head(self.status_int, self._headers.items())
+        key = (type(self), self.status_int, self.CORS_ENABLED)
+        head = _encoded_heads.get(key)
+        if head is None:
+            head = _encoded_heads[key] = encode_head(
+                self.status_int, self._default_header_items()
+            )
+        return head
+
+    def __getstate__(self):
+        # Only include the status_int slot if it was set on the instance, as
+        # opposed to being specified by a subclass attribute.
+        state = {k: getattr(self, k) for k in ('_headers', 'body',
+                                               'background')}
+        try:
+            state['status_int'] = Response.status_int.__get__(self)
+        except AttributeError:
+            pass
+        return state
+
+    def __setstate__(self, state):
+        # Set the slots directly, bypassing any subclass attributes of the
+        # same name.
+        for k, v in state.items():
+            Response.__dict__[k].__set__(self, v)
 
     def __repr__(self):
-        return repr(self.__dict__)
+        return repr({
+            'status_int': self.status_int,
+            'headers': self.headers,
+            'body': self.body,
+        })
 
 class _200(Response):
+    __slots__ = ()
     status_int = 200
 
 
 class _303(Response):
+    __slots__ = ()
     status_int = 303
 
     def __init__(self, location):
@@ -159,9 +369,19 @@ class _303(Response):
 
 
 class ErrorResponse(Response):
-    headers = {'content-type': 'text/plain'}
+    __slots__ = ()
+    default_headers = {'content-type': 'text/plain'}
+
+    def __init_subclass__(cls, **kwargs):
+        # Support the older style of specifying the reason as a class
+        # attribute named "body".
+        if 'body' in cls.__dict__:
+            cls.reason = cls.__dict__['body']
+            del cls.body
+        super().__init_subclass__(**kwargs)
+
     def __init__(self, details=None):
-        body = '{} {}'.format(self.status_int, self.body)
+        body = '{} {}'.format(self.status_int, self.reason)
         if details is not None:
             body = '{} - {}'.format(body, details)
 
@@ -169,28 +389,67 @@ class ErrorResponse(Response):
 
 
 class _400(ErrorResponse):
+    __slots__ = ()
     status_int = 400
-    body = 'Invalid Request'
+    reason = 'Invalid Request'
 
 
 class _404(ErrorResponse):
+    __slots__ = ()
     status_int = 404
-    body = 'Not Found'
+    reason = 'Not Found'
 
 
 class _405(ErrorResponse):
+    __slots__ = ()
     status_int = 405
-    body = 'Method Not Allowed'
+    reason = 'Method Not Allowed'
+
+
+class _408(ErrorResponse):
+    __slots__ = ()
+    status_int = 408
+    reason = 'Request Timeout'
+
+
+class _413(ErrorResponse):
+    __slots__ = ()
+    status_int = 413
+    reason = 'Payload Too Large'
+
+
+class _429(ErrorResponse):
+    __slots__ = ()
+    status_int = 429
+    reason = 'Too Many Requests'
+
+    def __init__(self, retry_after):
+        ErrorResponse.__init__(self)
+        self.headers['retry-after'] = str(retry_after)
 
 
 class _500(ErrorResponse):
+    __slots__ = ()
     status_int = 500
-    body = 'Server Error'
+    reason = 'Server Error'
+
+
+class _502(ErrorResponse):
+    __slots__ = ()
+    status_int = 502
+    reason = 'Bad Gateway'
 
 
 class _503(ErrorResponse):
+    __slots__ = ()
     status_int = 503
-    body = 'Service Unavailable'
+    reason = 'Service Unavailable'
+
+
+class _504(ErrorResponse):
+    __slots__ = ()
+    status_int = 504
+    reason = 'Gateway Timeout'
 
 
 ###############################################################################
@@ -207,9 +466,12 @@ APPLICATION_JSON = 'application/json'
 APPLICATION_OCTET_STREAM = 'application/octet-stream'
 APPLICATION_PYTHON = 'application/x-python'
 APPLICATION_SCHEMA_JSON = 'application/schema+json'
+APPLICATION_TAR = 'application/x-tar'
+APPLICATION_ZIP = 'application/zip'
 IMAGE_GIF = 'image/gif'
 IMAGE_JPEG = 'image/jpeg'
 IMAGE_PNG = 'image/png'
+MULTIPART_FORM_DATA = 'multipart/form-data'
 TEXT_CSS = 'text/css'
 TEXT_HTML = 'text/html'
 TEXT_PLAIN = 'text/plain'
@@ -226,18 +488,94 @@ FILE_LOWER_EXTENSION_CONTENT_TYPE_MAP = {
     'png': IMAGE_PNG,
     'py': APPLICATION_PYTHON,
     'schema.json': APPLICATION_SCHEMA_JSON,
+    'tar': APPLICATION_TAR,
     'txt': TEXT_PLAIN,
+    'zip': APPLICATION_ZIP,
 }
 
 MAX_FILE_EXTENSION_SEGMENTS = max(
     k.count('.') + 1 for k in FILE_LOWER_EXTENSION_CONTENT_TYPE_MAP
 )
 
+STREAMS_ENGINE = 'streams'
+PROTOCOL_ENGINE = 'protocol'
+
+# The max length of the queue of not-yet-accepted connections, which the
+# kernel further limits to e.g. net.core.somaxconn.
+LISTEN_BACKLOG = socket.SOMAXCONN
+
+# Whether to disable Nagle's algorithm on TCP connections, which serve() will
+# replace if specified.
+TCP_NODELAY = True
+
+# The file descriptor of the first socket passed by systemd socket
+# activation.
+SD_LISTEN_FDS_START = 3
+
+# The per-connection receive buffer size of the protocol engine, which also
+# limits the size of the request line and headers.
+RECV_BUFFER_BYTES = 16384
+
+# The size of the buffers used to send file-type response bodies, and the max
+# number of idle buffers to retain for reuse.
+SEND_BUFFER_BYTES = 1024
+SEND_BUFFER_POOL_SIZE = 16
+
+# Background task queue defaults.
+BACKGROUND_QUEUE_SIZE = 256
+BACKGROUND_WORKERS = 2
+BACKGROUND_MAX_RETRIES = 3
+BACKGROUND_RETRY_BACKOFF_SECONDS = 0.5
+
+# The max number of process pool worker processes, where None means one per
+# CPU.
+PROCESS_POOL_SIZE = None
+
 DELETE = 'DELETE'
 GET = 'GET'
 POST = 'POST'
 PUT = 'PUT'
 
+# The default max number of clients whose rate limit state is retained.
+RATE_LIMIT_MAX_CLIENTS = 10000
+
+# Request tracing defaults.
+TRACE_SAMPLE_RATE = 0.01
+TRACE_SLOW_THRESHOLD_SECONDS = 1
+TRACE_MAX_FILE_BYTES = 16 * 1024 * 1024
+TRACE_BACKUP_COUNT = 3
+TRACE_QUEUE_SIZE = 1024
+TRACE_MAX_SPANS = 256
+
+# Connection timeouts, in seconds, with the exception of min_upload_rate which
+# is in bytes per second. A value of None disables the corresponding check.
+#  - request_line: max wait for the complete request line
+#  - headers: max wait for the complete header block
+#  - body: max wait between received request body chunks
+#  - min_upload_rate: min average request body rate, enforced once the body
+#    has been streaming for longer than MIN_UPLOAD_RATE_GRACE_SECONDS
+#  - drain: max wait for a write to be flushed to the client
+Timeouts = namedtuple(
+    'Timeouts',
+    ('request_line', 'headers', 'body', 'min_upload_rate', 'drain'),
+    defaults=(10, 10, 30, 512, 30)
+)
+
+MIN_UPLOAD_RATE_GRACE_SECONDS = 5
+
+# The active timeouts, which serve() will replace if specified.
+TIMEOUTS = Timeouts()
+
+# Server-wide counters.
+metrics = {
+    'timed_out_connections': 0,
+    'abandoned_requests': 0,
+    'aborted_responses': 0,
+}
+
+# Coroutine functions registered with @on_disconnect.
+disconnect_hooks = []
+
 ###############################################################################
 # Exceptions
 ###############################################################################
@@ -247,6 +585,11 @@ class HTTPServerException(Exception): pass
 class ShortRead(HTTPServerException): pass
 class ZeroRead(HTTPServerException): pass
 class CouldNotParse(HTTPServerException): pass
+class RequestTimeout(HTTPServerException): pass
+class SendTimeout(HTTPServerException): pass
+class ClientDisconnected(HTTPServerException): pass
+class PayloadTooLarge(HTTPServerException): pass
+class ResponseIncomplete(HTTPServerException): pass
 
 ###############################################################################
 # Query Parameter Parsers
@@ -269,11 +612,42 @@ def as_type(t):
 def as_choice(*choices):
     return lambda x: x if x in choices else parsing_error()
 
+def as_bounded_int(min_value=None, max_value=None):
+    as_int = as_type(int)
+    def f(x):
+        x = as_int(x)
+        if ((min_value is not None and x < min_value) or
+            (max_value is not None and x > max_value)):
+            parsing_error()
+        return x
+    return f
+
+def as_list(parser, sep=None, min_len=0, max_len=None):
+    """Apply parser to every value of a repeated param, additionally splitting
+    each value on sep if specified, e.g. "?x=1&x=2,3".
+    """
+    def f(xs):
+        if xs is None:
+            xs = []
+        if sep is not None:
+            xs = [y for x in xs if x is not None for y in x.split(sep)]
+        if len(xs) < min_len or (max_len is not None and len(xs) > max_len):
+            parsing_error()
+        return [parser(x) for x in xs]
+    # Signal to the query param validator that this parser expects the list of
+    # all the param values.
+    f.multi_value = True
+    return f
+
+def _inherit_multi_value(f, parser):
+    f.multi_value = getattr(parser, 'multi_value', False)
+    return f
+
 def as_nonempty(parser):
     def f(x):
         x = parser(x)
         return x if len(x) > 0 else parsing_error()
-    return f
+    return _inherit_multi_value(f, parser)
 
 def with_default_as(parser, default):
     def f(x):
@@ -281,7 +655,7 @@ def with_default_as(parser, default):
             return parser(x)
         except CouldNotParse:
             return default
-    return f
+    return _inherit_multi_value(f, parser)
 
 def maybe_as(parser):
     def f(x):
@@ -289,7 +663,7 @@ def maybe_as(parser):
             return parser(x)
         except CouldNotParse:
             return x if x is None else parsing_error()
-    return f
+    return _inherit_multi_value(f, parser)
 
 ###############################################################################
 # Utility Functions
@@ -315,54 +689,62 @@ def get_file_path_content_type(fs_path):
     # 'application/octet-stream'.
     return APPLICATION_OCTET_STREAM
 
-def parse_uri(uri):
-    if '?' not in uri:
-        return uri, {}
-    # TODO - URL unencoding
-    path, query_string = uri.split('?')
-    query = {}
+_unquote = lambda s: unquote_plus(s) if '%' in s or '+' in s else s
+
+def parse_query_string(query_string):
+    """Return a map of URL-decoded param names to the list of their values.
+    A param without a "=" has the value None.
+    """
+    params = {}
     for pair_str in query_string.split('&'):
-        kv = pair_str.split('=')
-        kv_len = len(kv)
-        if kv_len == 2:
-            k, v = kv
-            query[k] = v
-        elif kv_len == 1:
-            query[kv[0]] = None
-        else:
-            if DEBUG:
-                print('Unparsable query param: "{}"'.format(pair_str))
-    return path, query
+        if not pair_str:
+            continue
+        k, sep, v = pair_str.partition('=')
+        params.setdefault(_unquote(k), []).append(_unquote(v) if sep else None)
+    return params
+
+def parse_uri(uri):
+    """Return a (<path>, <Query>) tuple for the specified request URI.
+    """
+    path, _, query_string = uri.partition('?')
+    return path, Query(query_string)
 
-async def next_line(reader):
+async def with_timeout(aw, timeout, exc):
+    """Await aw, raising exc if it does not complete within timeout seconds.
+    """
+    if timeout is None:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, timeout)
+    except asyncio.TimeoutError:
+        raise exc
+
+async def next_line(reader, timeout=None):
     """Given a request reader, return the bytes up to, but excluding,
     the next CRLF (i.e. b'\r\n') delimiter.
     """
     try:
-        return (await reader.readuntil(CRLF))[:-2]
+        return (await with_timeout(
+            reader.readuntil(CRLF), timeout, RequestTimeout
+        ))[:-2]
     except asyncio.IncompleteReadError:
         raise ShortRead
 
-async def parse_request(reader, writer):
-    # Parse the request line.
+def build_request(reader, writer, request_line, header_lines):
+    """Return a Request for the specified request line and header lines bytes.
+    """
     try:
-        request_line = await next_line(reader)
-    except ShortRead:
-        raise ZeroRead
-    method, uri, protocol_version = _decode(request_line).split()
+        method, uri, protocol_version = _decode(request_line).split()
+    except ValueError:
+        raise CouldNotParse('Malformed request line')
     path, query = parse_uri(uri)
-
-    # Parse the headers.
     headers = {}
-    while True:
-        data = await next_line(reader)
-        if data == b'':
-            # Reached double-CRLF which signals the end of the headers.
-            break
-        k, v = _decode(data).split(':', 1)
+    for data in header_lines:
+        k, sep, v = _decode(data).partition(':')
+        if not sep:
+            raise CouldNotParse('Malformed header')
         # Lowercase the header names for internal consistency.
         headers[k.strip().lower()] = v.strip()
-
     return Request(
         reader=reader,
         writer=writer,
@@ -374,100 +756,1074 @@ async def parse_request(reader, writer):
         body=reader,
     )
 
+async def parse_request(reader, writer):
+    # Read the request line.
+    try:
+        request_line = await next_line(reader, TIMEOUTS.request_line)
+    except ShortRead:
+        raise ZeroRead
+
+    # Read the headers, all of which must arrive before the deadline.
+    header_lines = []
+    loop = asyncio.get_event_loop()
+    deadline = (
+        None if TIMEOUTS.headers is None
+        else loop.time() + TIMEOUTS.headers
+    )
+    while True:
+        data = await next_line(
+            reader,
+            None if deadline is None else max(deadline - loop.time(), 0)
+        )
+        if data == b'':
+            # Reached double-CRLF which signals the end of the headers.
+            break
+        header_lines.append(data)
+
+    return build_request(reader, writer, request_line, header_lines)
+
+async def read_body(request, max_chunk_bytes=1024):
+    """An async generator that yields the request body in chunks of up to
+    max_chunk_bytes, enforcing the body inactivity and minimum upload rate
+    timeouts.
+    """
+    bytes_remaining = int(request.headers.get('content-length', 0))
+    loop = asyncio.get_event_loop()
+    start_time = loop.time()
+    bytes_read = 0
+    while bytes_remaining > 0:
+        chunk = await with_timeout(
+            request.reader.read(min(bytes_remaining, max_chunk_bytes)),
+            TIMEOUTS.body,
+            RequestTimeout
+        )
+        if not chunk:
+            raise ShortRead
+        bytes_remaining -= len(chunk)
+        bytes_read += len(chunk)
+        if TIMEOUTS.min_upload_rate is not None:
+            elapsed = loop.time() - start_time
+            if (elapsed > MIN_UPLOAD_RATE_GRACE_SECONDS and
+                bytes_read / elapsed < TIMEOUTS.min_upload_rate):
+                raise RequestTimeout
+        yield chunk
+
+def compile_query_param_parser_map(parser_map):
+    """Return a function that accepts a Query and returns an
+    (<ok_params>, <bad_params>) tuple as the result of applying the parsers
+    to the query params.
+    """
+    parsers = tuple(
+        (k, parser, getattr(parser, 'multi_value', False))
+        for k, parser in parser_map.items()
+    )
+    def validate(query):
+        params = query.params
+        ok_params = {}
+        bad_params = {}
+        for k, parser, multi_value in parsers:
+            v = params.get(k)
+            if v is not None and not multi_value:
+                v = v[-1]
+            try:
+                ok_params[k] = parser(v)
+            except CouldNotParse:
+                bad_params[k] = v
+        return ok_params, bad_params
+    return validate
+
 def parse_query_params(request, parser_map):
     """Apply parsers to the request query params.
     """
-    query = request.query
-    ok_params = {}
-    bad_params = {}
-    for k, parser in parser_map.items():
-        v = query.get(k)
-        try:
-            ok_params[k] = parser(v)
-        except CouldNotParse:
-            bad_params[k] = v
-    return ok_params, bad_params
+    return compile_query_param_parser_map(parser_map)(request.query)
 
 ###############################################################################
 # Connection Handling
 ###############################################################################
 
+class BufferPool:
+    """A pool of reusable fixed-size memoryview buffers that retains at most
+    max_size released buffers.
+    """
+    __slots__ = ('buffer_size', 'max_size', 'buffers')
+
+    def __init__(self, buffer_size, max_size):
+        self.buffer_size = buffer_size
+        self.max_size = max_size
+        self.buffers = []
+
+    def acquire(self):
+        if self.buffers:
+            return self.buffers.pop()
+        return memoryview(bytearray(self.buffer_size))
+
+    def release(self, buf):
+        if len(self.buffers) < self.max_size:
+            self.buffers.append(buf)
+
+send_buffer_pool = BufferPool(SEND_BUFFER_BYTES, SEND_BUFFER_POOL_SIZE)
+
+async def drain(writer):
+    """Wait for the writer buffer to be flushed, raising SendTimeout if the
+    client stalls for longer than the drain timeout.
+    """
+    with trace_span('drain'):
+        await with_timeout(writer.drain(), TIMEOUTS.drain, SendTimeout)
+
+async def _close(writer):
+    """Close the writer, aborting the connection if the client does not accept
+    the remaining buffered data within the drain timeout.
+    """
+    writer.close()
+    try:
+        await with_timeout(writer.wait_closed(), TIMEOUTS.drain, SendTimeout)
+    except SendTimeout:
+        writer.transport.abort()
+
 async def send(writer, response, close=True):
     """Write a response to writer stream.
     """
     if DEBUG:
         print('sending response: {}'.format(response))
-    writer.write('HTTP/1.1 {} OK\n'.format(response.status_int).encode())
-    for k, v in response.headers.items():
-        writer.write('{}: {}\n'.format(k, v).encode())
-    writer.write(b'\n')
-    await writer.drain()
+    with trace_span('send', {'status': response.status_int}):
+        await _send(writer, response, close)
+
+async def _send(writer, response, close):
+    writer.write(response.encode_head())
+    await drain(writer)
 
     if response.body is not None:
-        if not hasattr(response.body, 'readinto'):
-            # Assume that body is a string and send it.
-            writer.write(response.body.encode())
-            await writer.drain()
-        else:
-            # Assume that body is a file-type object and iterate over it
-            # sending each chunk to avoid exhausting the available memory by
-            # doing it all in one go.
-            chunk_mv = memoryview(bytearray(1024))
-            num_bytes = 0
+        try:
+            await _send_body(writer, response.body)
+        except SendTimeout:
+            raise
+        except Exception as e:
+            # The head has already been sent, so it's too late to send an
+            # error response.
+            raise ResponseIncomplete(
+                'Failed to send the response body: {}'.format(e)
+            ) from e
+    # Maybe close the writer.
+    if close:
+        await _close(writer)
+
+async def _send_body(writer, body):
+    if not hasattr(body, 'readinto'):
+        # Assume that body is a string and send it.
+        writer.write(body.encode())
+        await drain(writer)
+    else:
+        # Assume that body is a file-type object and iterate over it sending
+        # each chunk to avoid exhausting the available memory by doing it all
+        # in one go.
+        chunk_mv = send_buffer_pool.acquire()
+        num_bytes = 0
+        try:
             while True:
-                num_bytes = response.body.readinto(chunk_mv)
+                num_bytes = body.readinto(chunk_mv)
                 if num_bytes == 0 or num_bytes is None:
                     break
                 writer.write(chunk_mv[:num_bytes])
-                await writer.drain()
-    # Maybe close the writer.
-    if close:
-        writer.close()
-        await writer.wait_closed()
+                await drain(writer)
+        finally:
+            send_buffer_pool.release(chunk_mv)
+            if hasattr(body, 'close'):
+                body.close()
+
+def has_body(request):
+    return (int(request.headers.get('content-length') or 0) > 0 or
+            'transfer-encoding' in request.headers)
+
+def on_disconnect(func):
+    """Register a coroutine function to be called with the request after its
+    handler has been cancelled because the client disconnected.
+    """
+    disconnect_hooks.append(func)
+    return func
 
-async def service_connection(reader, writer):
-    """Handle a new server connection.
+async def dispatch_until_disconnect(request, wait_for_disconnect):
+    """Dispatch the request and, if the wait_for_disconnect coroutine returns
+    True before the handler completes, cancel the handler, call the disconnect
+    hooks, and raise ClientDisconnected.
+    """
+    loop = asyncio.get_event_loop()
+    handler = loop.create_task(dispatch(request))
+    watcher = loop.create_task(wait_for_disconnect)
+    try:
+        await asyncio.wait((handler, watcher),
+                           return_when=asyncio.FIRST_COMPLETED)
+        if handler.done() or not watcher.result():
+            return await handler
+    finally:
+        watcher.cancel()
+        # Ensure that the handler doesn't outlive this task if this task was
+        # itself cancelled.
+        handler.cancel()
+
+    metrics['abandoned_requests'] += 1
+    try:
+        await handler
+    except asyncio.CancelledError:
+        pass
+    for hook in disconnect_hooks:
+        try:
+            await hook(request)
+        except Exception:
+            print_exc()
+    raise ClientDisconnected
+
+async def _wait_for_stream_disconnect(request):
+    """Return True if the client resets the connection or it's otherwise
+    lost, or False if the client sends anything else. A half-close by the
+    client isn't a disconnect, since it may still be waiting for the
+    response.
+    """
+    try:
+        if await request.reader.read(1) != b'':
+            return False
+        # Wait for the connection to be lost.
+        await request.writer.wait_closed()
+    except ConnectionError:
+        pass
+    return True
+
+async def service_request(writer, parse, wait_for_disconnect=None):
+    """Await the parse coroutine and dispatch the resulting request, sending an
+    error response if anything goes wrong. If specified, wait_for_disconnect is
+    a coroutine function that will be called with a request without a body
+    and which returns True if the client disconnects, in which case the
+    handler is cancelled.
     """
+    request = None
+    trace = None
+    if tracer is not None:
+        trace = tracer.start_trace()
+        token = _current_trace.set(trace)
     try:
-        request = await parse_request(reader, writer)
+        with trace_span('parse_request'):
+            request = await parse
         if DEBUG:
             print('request: {}'.format(request))
-        await dispatch(request)
+        if wait_for_disconnect is None or has_body(request):
+            await dispatch(request)
+        else:
+            await dispatch_until_disconnect(request,
+                                            wait_for_disconnect(request))
     except KeyboardInterrupt:
-        writer.close()
-        await writer.wait_closed()
+        await _close(writer)
         raise
+    except ClientDisconnected:
+        writer.transport.abort()
+    except RequestTimeout:
+        # The client was too slow to send its request, so try to let it know
+        # before closing the connection.
+        metrics['timed_out_connections'] += 1
+        try:
+            await send(writer, _408())
+        except Exception:
+            await _close(writer)
+    except SendTimeout:
+        # The client stopped accepting data, so just drop it.
+        metrics['timed_out_connections'] += 1
+        writer.transport.abort()
+    except CouldNotParse as e:
+        try:
+            await send(writer, _400(str(e)))
+        except Exception:
+            await _close(writer)
+    except PayloadTooLarge as e:
+        try:
+            await send(writer, _413(str(e)))
+        except Exception:
+            await _close(writer)
+    except ResponseIncomplete:
+        # Abort the connection so that the client sees a truncated response
+        # instead of an error response appended to the partial body.
+        print_exc()
+        metrics['aborted_responses'] += 1
+        writer.transport.abort()
     except Exception as e:
         print_exc()
         try:
             await send(writer, _500(str(e)))
         except Exception:
             print_exc()
-        writer.close()
-        await writer.wait_closed()
+        await _close(writer)
+    finally:
+        if trace is not None:
+            _current_trace.reset(token)
+            if tracer is not None:
+                tracer.finish_trace(trace, {} if request is None else {
+                    'method': request.method,
+                    'path': request.path,
+                })
+
+def _disable_tcp_nodelay(sock):
+    # asyncio enables TCP_NODELAY on every TCP connection, so it only ever
+    # needs to be disabled.
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0)
+
+async def service_connection(reader, writer):
+    """Handle a new server connection.
+    """
+    if not TCP_NODELAY:
+        _disable_tcp_nodelay(writer.get_extra_info('socket'))
+    await service_request(writer, parse_request(reader, writer),
+                          _wait_for_stream_disconnect)
+
+def unix_listener(path, mode=None):
+    """Return a Unix socket bound to path, replacing any stale socket file,
+    with its permissions set to mode before it starts listening.
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        if mode is not None:
+            os.chmod(path, mode)
+    except Exception:
+        sock.close()
+        raise
+    return sock
 
-async def serve(host='0.0.0.0', port='8000', backlog=5, enable_cors=True):
-    """Start the webserver.
+def systemd_listen_fds():
+    """Return the list of file descriptors passed to this process by systemd
+    socket activation.
     """
+    if os.environ.get('LISTEN_PID') != str(os.getpid()):
+        return []
+    num_fds = int(os.environ.get('LISTEN_FDS') or 0)
+    return list(range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + num_fds))
+
+async def serve(host='0.0.0.0', port=8000, backlog=LISTEN_BACKLOG,
+                enable_cors=True, timeouts=None, engine=STREAMS_ENGINE,
+                path=None, path_mode=None, sock=None, fd=None,
+                tcp_nodelay=True, rcvbuf=None, sndbuf=None,
+                rate_limit=None):
+    """Start the webserver using the specified engine, i.e. either
+    STREAMS_ENGINE, which is built on asyncio streams, or PROTOCOL_ENGINE,
+    which is built on a lower-overhead asyncio.BufferedProtocol.
+
+    The server listens on either an already-open socket, sock, or one
+    identified by its file descriptor, fd, e.g. as passed by systemd socket
+    activation, or a Unix socket at path, with permissions path_mode, or
+    else host and port. rcvbuf and sndbuf set the socket buffer sizes of
+    connections.
+
+    rate_limit is an optional RateLimiter to apply to every request, in
+    addition to any per-route limits.
+    """
+    global TCP_NODELAY, TIMEOUTS, rate_limiter
+    if engine not in (STREAMS_ENGINE, PROTOCOL_ENGINE):
+        raise ValueError('Unsupported engine: {}'.format(engine))
+    if sum(x is not None for x in (sock, fd, path)) > 1:
+        raise ValueError('Specify at most one of sock, fd and path')
     Response.CORS_ENABLED = enable_cors
-    return await asyncio.start_server(
-        service_connection,
-        host,
-        port,
-        backlog=backlog
-    )
+    TCP_NODELAY = tcp_nodelay
+    rate_limiter = rate_limit
+    if timeouts is not None:
+        TIMEOUTS = timeouts
+
+    if fd is not None:
+        sock = socket.socket(fileno=fd)
+    elif path is not None:
+        sock = unix_listener(path, path_mode)
+    if sock is not None:
+        address = {'sock': sock}
+    else:
+        address = {'host': host, 'port': port}
+
+    if engine == STREAMS_ENGINE:
+        server = await asyncio.start_server(
+            service_connection,
+            backlog=backlog,
+            start_serving=False,
+            **address
+        )
+    else:
+        server = await asyncio.get_event_loop().create_server(
+            HTTPProtocol,
+            backlog=backlog,
+            start_serving=False,
+            **address
+        )
+    # Accepted connections inherit the buffer sizes of the listening socket,
+    # which must be set before it starts listening to affect the TCP window
+    # scaling of those connections.
+    for listener in server.sockets:
+        if rcvbuf is not None:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        if sndbuf is not None:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    await server.start_serving()
+    return server
+
+###############################################################################
+# Protocol Engine
+###############################################################################
+
+def install_uvloop():
+    """Set the uvloop event loop policy if uvloop is installed, and return a
+    bool indicating whether it was.
+    """
+    if uvloop is None:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+async def _raise(exc):
+    raise exc
+
+class ProtocolReader:
+    """A minimal StreamReader-compatible interface to the request body bytes
+    received by an HTTPProtocol.
+    """
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    async def _wait_for_data(self):
+        """Wait for more data to be received, returning False if the client
+        has already sent EOF.
+        """
+        protocol = self.protocol
+        if protocol.eof:
+            return False
+        protocol.read_waiter = protocol.loop.create_future()
+        try:
+            await protocol.read_waiter
+        finally:
+            protocol.read_waiter = None
+        return True
+
+    async def read(self, n=-1):
+        protocol = self.protocol
+        while protocol.start == protocol.end:
+            if not await self._wait_for_data():
+                return b''
+        end = protocol.end if n < 0 else min(protocol.start + n, protocol.end)
+        return protocol.consume(end)
+
+    async def readuntil(self, separator=b'\n'):
+        protocol = self.protocol
+        while True:
+            i = protocol.buf.find(separator, protocol.start, protocol.end)
+            if i != -1:
+                return protocol.consume(i + len(separator))
+            if not await self._wait_for_data():
+                partial = protocol.consume(protocol.end)
+                raise asyncio.IncompleteReadError(partial, None)
+
+class ProtocolWriter:
+    """A minimal StreamWriter-compatible interface to an HTTPProtocol
+    transport.
+    """
+    def __init__(self, protocol, transport):
+        self.protocol = protocol
+        self.transport = transport
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    async def drain(self):
+        protocol = self.protocol
+        if protocol.lost:
+            raise ConnectionResetError('Connection lost')
+        if protocol.write_paused:
+            protocol.drain_waiter = protocol.loop.create_future()
+            try:
+                await protocol.drain_waiter
+            finally:
+                protocol.drain_waiter = None
+
+    def close(self):
+        self.transport.close()
+
+    async def wait_closed(self):
+        await asyncio.shield(self.protocol.closed)
+
+class HTTPProtocol(asyncio.BufferedProtocol):
+    """An asyncio.BufferedProtocol that parses requests directly from a
+    reusable receive buffer and services them with the same dispatch machinery
+    as the streams engine.
+    """
+    def __init__(self):
+        self.loop = asyncio.get_event_loop()
+        self.buf = bytearray(RECV_BUFFER_BYTES)
+        # The buffer offsets of the unconsumed received bytes.
+        self.start = 0
+        self.end = 0
+        self.eof = False
+        self.lost = False
+        self.reading_paused = False
+        self.write_paused = False
+        self.read_waiter = None
+        self.drain_waiter = None
+        self.request_line_seen = False
+        self.timer = None
+        self.task = None
+        self.closed = self.loop.create_future()
+        # Resolved when the client sends EOF or the connection is lost.
+        self.disconnected = self.loop.create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if not TCP_NODELAY:
+            _disable_tcp_nodelay(transport.get_extra_info('socket'))
+        self.reader = ProtocolReader(self)
+        self.writer = ProtocolWriter(self, transport)
+        self._set_timer(TIMEOUTS.request_line)
+
+    def _set_timer(self, timeout):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if timeout is not None:
+            self.timer = self.loop.call_later(timeout, self._on_timeout)
+
+    def _on_timeout(self):
+        self.timer = None
+        self._service(_raise(RequestTimeout))
+
+    def _service(self, parse):
+        self._set_timer(None)
+        self.task = self.loop.create_task(
+            service_request(self.writer, parse, self._wait_for_disconnect)
+        )
+
+    async def _wait_for_disconnect(self, request):
+        await asyncio.shield(self.disconnected)
+        return True
+
+    def consume(self, end):
+        """Return and consume the received bytes up to the end offset.
+        """
+        data = bytes(self.buf[self.start:end])
+        self.start = end
+        if self.start == self.end:
+            self.start = self.end = 0
+        if self.reading_paused:
+            self.reading_paused = False
+            self.transport.resume_reading()
+        return data
+
+    def get_buffer(self, sizehint):
+        if self.start > 0 and self.end == len(self.buf):
+            # Move the unconsumed bytes to the start of the buffer.
+            n = self.end - self.start
+            self.buf[:n] = self.buf[self.start:self.end]
+            self.start, self.end = 0, n
+        return memoryview(self.buf)[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        if self.task is None:
+            self._parse_head()
+        elif self.read_waiter is not None and not self.read_waiter.done():
+            self.read_waiter.set_result(None)
+        if self.end == len(self.buf) and self.task is not None:
+            # The buffer is full, so stop reading until the handler consumes
+            # some of it.
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+    def _parse_head(self):
+        buf = self.buf
+        if not self.request_line_seen:
+            if buf.find(CRLF, self.start, self.end) == -1:
+                if self.end == len(buf):
+                    self._service(_raise(CouldNotParse('Request too large')))
+                return
+            self.request_line_seen = True
+            self._set_timer(TIMEOUTS.headers)
+        i = buf.find(CRLF + CRLF, self.start, self.end)
+        if i == -1:
+            if self.end == len(buf):
+                self._service(_raise(CouldNotParse('Request too large')))
+            return
+        lines = bytes(buf[self.start:i]).split(CRLF)
+        self.start = i + 4
+        if self.start == self.end:
+            self.start = self.end = 0
+        self._service(self._build_request(lines[0], lines[1:]))
+
+    async def _build_request(self, request_line, header_lines):
+        return build_request(self.reader, self.writer, request_line,
+                             header_lines)
+
+    def eof_received(self):
+        self.eof = True
+        # This isn't treated as a disconnect, since the client may have only
+        # half-closed the connection and still be waiting for the response.
+        if self.read_waiter is not None and not self.read_waiter.done():
+            self.read_waiter.set_result(None)
+        if self.task is None:
+            # The client went away without sending a complete request.
+            return False
+        # Keep the transport open so that the response can still be sent.
+        return True
+
+    def pause_writing(self):
+        self.write_paused = True
+
+    def resume_writing(self):
+        self.write_paused = False
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+
+    def connection_lost(self, exc):
+        self.lost = True
+        self.eof = True
+        self._set_timer(None)
+        for waiter in (self.read_waiter, self.drain_waiter):
+            if waiter is not None and not waiter.done():
+                waiter.set_exception(
+                    exc or ConnectionResetError('Connection lost')
+                )
+        if not self.disconnected.done():
+            self.disconnected.set_result(None)
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+###############################################################################
+# Background Tasks
+###############################################################################
+
+class TaskQueue:
+    """A bounded queue of coroutine functions that are called by a fixed-size
+    pool of worker tasks, with retry on failure and exponential backoff.
+    """
+    def __init__(self, max_size=BACKGROUND_QUEUE_SIZE,
+                 num_workers=BACKGROUND_WORKERS,
+                 max_retries=BACKGROUND_MAX_RETRIES,
+                 retry_backoff=BACKGROUND_RETRY_BACKOFF_SECONDS):
+        self.max_size = max_size
+        self.num_workers = num_workers
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.loop = None
+        self.queue = None
+        self.workers = []
+        self.closed = False
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        # The seconds between the enqueuing and start of the most recent task,
+        # and the max of that value since the queue was started.
+        self.lag = 0
+        self.max_lag = 0
+
+    def _start(self):
+        self.loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue(self.max_size)
+        # Create the workers in an empty context so that they don't inherit
+        # the context variables, e.g. the Trace, of the request that happens
+        # to start the queue.
+        context = contextvars.Context()
+        self.workers = [
+            context.run(self.loop.create_task, self._work())
+            for _ in range(self.num_workers)
+        ]
+
+    async def put(self, func, args=(), kwargs=None):
+        """Enqueue a call to func, waiting for space if the queue is full.
+        """
+        if self.closed:
+            raise RuntimeError('TaskQueue is shut down')
+        if self.loop is not asyncio.get_event_loop():
+            self._start()
+        await self.queue.put((time.monotonic(), func, args, kwargs or {}))
+
+    async def _work(self):
+        while True:
+            enqueued_at, func, args, kwargs = await self.queue.get()
+            self.lag = time.monotonic() - enqueued_at
+            self.max_lag = max(self.max_lag, self.lag)
+            try:
+                await self._call(func, args, kwargs)
+            finally:
+                self.queue.task_done()
+
+    async def _call(self, func, args, kwargs):
+        attempt = 0
+        while True:
+            try:
+                await func(*args, **kwargs)
+                self.completed += 1
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                if attempt == self.max_retries:
+                    print_exc()
+                    self.failed += 1
+                    return
+                await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+                attempt += 1
+                self.retried += 1
+
+    def stats(self):
+        return {
+            'depth': 0 if self.queue is None else self.queue.qsize(),
+            'lag': self.lag,
+            'max_lag': self.max_lag,
+            'completed': self.completed,
+            'failed': self.failed,
+            'retried': self.retried,
+        }
+
+    async def shutdown(self, timeout=None):
+        """Stop accepting tasks, wait up to timeout seconds for the queued
+        tasks to complete, and stop the workers.
+        """
+        self.closed = True
+        if self.queue is None:
+            return
+        try:
+            await with_timeout(self.queue.join(), timeout, asyncio.TimeoutError)
+        except asyncio.TimeoutError:
+            pass
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+# The queue used for the tasks added with Response.add_background_task().
+background_tasks = TaskQueue()
+
+###############################################################################
+# Process Pool
+###############################################################################
+
+class ProcessPool:
+    """A lazily-created ProcessPoolExecutor for running CPU-bound functions
+    without blocking the event loop.
+    """
+    def __init__(self, max_workers=PROCESS_POOL_SIZE):
+        self.max_workers = max_workers
+        self.executor = None
+
+    async def run(self, func, args=(), kwargs=None, timeout=None):
+        """Run func(*args, **kwargs) in a worker process and return its result,
+        raising asyncio.TimeoutError if it takes longer than timeout seconds.
+        On timeout or cancellation, a call that has not yet started is
+        cancelled, while one that is already running is left to complete and
+        its result discarded.
+        """
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.max_workers)
+        future = asyncio.wrap_future(
+            self.executor.submit(func, *args, **(kwargs or {}))
+        )
+        if timeout is None:
+            return await future
+        return await asyncio.wait_for(future, timeout)
+
+    def shutdown(self, wait=True):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+
+# The pool used by the @in_process_pool decorator.
+process_pool = ProcessPool()
+
+###############################################################################
+# Tracing
+###############################################################################
+
+# The Trace of the request being serviced by the current task, if any.
+_current_trace = contextvars.ContextVar('femtoweb_trace', default=None)
+
+class Trace:
+    """The spans recorded while servicing a single request, each of which is
+    a (name, start, end, args) tuple with perf_counter() start and end times.
+    """
+    __slots__ = ('id', 'start', 'spans', 'dropped')
+
+    def __init__(self, trace_id):
+        self.id = trace_id
+        self.start = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+
+    def add(self, name, start, end, args):
+        if len(self.spans) < TRACE_MAX_SPANS:
+            self.spans.append((name, start, end, args))
+        else:
+            self.dropped += 1
+
+class Span:
+    """A context manager that records the duration of its block as a span of
+    a trace.
+    """
+    __slots__ = ('trace', 'name', 'args', 'start')
+
+    def __init__(self, trace, name, args):
+        self.trace = trace
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.add(self.name, self.start, time.perf_counter(), self.args)
+
+# The context manager returned by trace_span() when there's nothing to trace.
+_null_span = nullcontext()
+
+def trace_span(name, args=None):
+    """Return a context manager that records the duration of its block as a
+    span of the current request's trace, if it's being traced.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return _null_span
+    return Span(trace, name, args)
+
+class Tracer:
+    """Records the spans of every request, and writes the traces of a
+    sample_rate fraction of requests, plus those of every request that takes
+    longer than slow_threshold seconds, to a file of Chrome trace events.
+
+    Traces are written from a background thread to path, which is rotated,
+    keeping backup_count old files, once it exceeds max_file_bytes. Each file
+    starts with a "[" line followed by one event object and a trailing comma
+    per line, which is a valid, unterminated Chrome trace JSON array.
+    """
+    def __init__(self, path, sample_rate=TRACE_SAMPLE_RATE,
+                 slow_threshold=TRACE_SLOW_THRESHOLD_SECONDS,
+                 max_file_bytes=TRACE_MAX_FILE_BYTES,
+                 backup_count=TRACE_BACKUP_COUNT,
+                 queue_size=TRACE_QUEUE_SIZE):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.max_file_bytes = max_file_bytes
+        self.backup_count = backup_count
+        self.queue = queue.Queue(queue_size)
+        self.thread = None
+        self.next_id = 0
+        self.written = 0
+        self.dropped = 0
+        # The offset to convert perf_counter() times to epoch times.
+        self.time_offset = time.time() - time.perf_counter()
+        self.pid = os.getpid()
+
+    def start_trace(self):
+        self.next_id += 1
+        return Trace(self.next_id)
+
+    def finish_trace(self, trace, args):
+        """Queue the trace to be written if it's sampled or slow.
+        """
+        end = time.perf_counter()
+        if (end - trace.start < self.slow_threshold and
+            random.random() >= self.sample_rate):
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._write_traces,
+                                           daemon=True)
+            self.thread.start()
+        try:
+            self.queue.put_nowait((trace, end, args))
+        except queue.Full:
+            self.dropped += 1
+
+    def _event(self, trace_id, name, start, end, args):
+        event = {
+            'name': name,
+            'ph': 'X',
+            'ts': round((start + self.time_offset) * 1e6),
+            'dur': round((end - start) * 1e6),
+            'pid': self.pid,
+            'tid': trace_id,
+        }
+        if args:
+            event['args'] = args
+        return event
+
+    def encode_trace(self, trace, end, args):
+        """Return the trace as Chrome trace event lines, with each request on
+        its own named track.
+        """
+        args = dict(args)
+        if trace.dropped:
+            args['dropped_spans'] = trace.dropped
+        events = [
+            {
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': self.pid,
+                'tid': trace.id,
+                'args': {'name': 'request {}'.format(trace.id)},
+            },
+            self._event(trace.id, 'request', trace.start, end, args),
+        ]
+        for span in trace.spans:
+            events.append(self._event(trace.id, *span))
+        return ''.join(
+            json.dumps(event, separators=(',', ':')) + ',\n'
+            for event in events
+        )
+
+    def _open(self):
+        fh = open(self.path, 'a')
+        if fh.tell() == 0:
+            fh.write('[\n')
+        return fh
+
+    def _rotate(self):
+        for i in range(self.backup_count - 1, 0, -1):
+            src = '{}.{}'.format(self.path, i)
+            if os.path.exists(src):
+                os.replace(src, '{}.{}'.format(self.path, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+    def _write_traces(self):
+        fh = self._open()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                try:
+                    # Rotate the file if it's full, unless it has no events.
+                    if fh.tell() >= max(self.max_file_bytes, 3):
+                        fh.close()
+                        self._rotate()
+                        fh = self._open()
+                    fh.write(self.encode_trace(*item))
+                    # Flush once there's nothing else to write.
+                    if self.queue.empty():
+                        fh.flush()
+                    self.written += 1
+                except Exception:
+                    print_exc()
+        finally:
+            fh.close()
+
+    def close(self, timeout=None):
+        """Write any queued traces and stop the writer thread.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join(timeout)
+            self.thread = None
+
+# The active Tracer, if any, which enable_tracing() will replace.
+tracer = None
+
+def enable_tracing(path, **kwargs):
+    """Start tracing requests, passing the path and kwargs to Tracer, and
+    return the Tracer.
+    """
+    global tracer
+    disable_tracing()
+    tracer = Tracer(path, **kwargs)
+    return tracer
+
+def disable_tracing():
+    global tracer
+    if tracer is not None:
+        tracer.close()
+        tracer = None
+
+###############################################################################
+# Rate Limiting
+###############################################################################
+
+class RateLimiter:
+    """A per-client token bucket rate limiter that allows an average of rate
+    requests per second in bursts of up to burst requests. Clients are keyed
+    by the value of the key_header request header, if specified and present,
+    and otherwise by their address.
+
+    Each bucket is stored as the single float "theoretical arrival time" of
+    the equivalent generic cell rate algorithm, in an LRU mapping of at most
+    max_clients buckets. Evicting a bucket is equivalent to refilling it.
+    """
+    def __init__(self, rate, burst=1, key_header=None,
+                 max_clients=RATE_LIMIT_MAX_CLIENTS):
+        if not rate > 0:
+            raise ValueError('rate must be greater than 0')
+        if not burst >= 1:
+            raise ValueError('burst must be at least 1')
+        self.interval = 1 / rate
+        self.burst_interval = burst * self.interval
+        self.key_header = key_header
+        self.max_clients = max_clients
+        # Map keys to theoretical arrival times in least to most recently
+        # used order.
+        self.buckets = OrderedDict()
+        self.limited = 0
+
+    def key(self, request):
+        if self.key_header is not None:
+            value = request.headers.get(self.key_header)
+            if value is not None:
+                return value
+        # Key IP clients by host, ignoring the port.
+        peername = request.writer.get_extra_info('peername')
+        return peername[0] if isinstance(peername, tuple) else peername
+
+    def acquire(self, key):
+        """Take a token from the bucket of key and return 0 or, if the bucket
+        is empty, return the number of seconds until it won't be.
+        """
+        now = time.monotonic()
+        buckets = self.buckets
+        tat = max(buckets.get(key, now), now) + self.interval
+        allow_at = tat - self.burst_interval
+        if allow_at > now:
+            # Keep limited clients, which must already have buckets, from
+            # being evicted.
+            buckets.move_to_end(key)
+            self.limited += 1
+            return allow_at - now
+        buckets[key] = tat
+        buckets.move_to_end(key)
+        if len(buckets) > self.max_clients:
+            buckets.popitem(last=False)
+        return 0
+
+    def check(self, request):
+        """Return a 429 response if the request exceeds the rate limit,
+        otherwise None.
+        """
+        retry_after = self.acquire(self.key(request))
+        if retry_after:
+            return _429(math.ceil(retry_after))
+        return None
+
+# The RateLimiter applied to every request, if any, which serve() will
+# replace if specified.
+rate_limiter = None
 
 ###############################################################################
 # Routing
 ###############################################################################
 
 # Define a module-level variable to store (<pathRegex>, <allowedMethods>,
-# <query_param_parser_map>, <func>) tuples for functions decorated with @route.
+# <query_param_validator>, <func>) tuples for functions decorated with @route.
 _routes = []
 
-def route(path_pattern, methods=('GET',), query_param_parser_map=None):
+def route(path_pattern, methods=('GET',), query_param_parser_map=None,
+          rate_limit=None):
     """A decorator to register a function as the handler for requests to the
-    specified path regex pattern and send any returned response.
+    specified path regex pattern and send any returned response, optionally
+    limiting the rate of requests per client with a RateLimiter.
     """
     def decorator(func):
         """Return a function that will accept a request argument, invoke the
@@ -483,47 +1839,69 @@ def route(path_pattern, methods=('GET',), query_param_parser_map=None):
         async def wrapper(request, *args, **kwargs):
             """Invoke the request handler and send any response.
             """
-            response = await func(request, *args, **kwargs)
+            response = (
+                None if rate_limit is None else rate_limit.check(request)
+            )
+            if response is None:
+                with trace_span('handler'):
+                    response = await func(request, *args, **kwargs)
             if response is not None:
-                await send(request.writer, response)
+                try:
+                    await send(request.writer, response)
+                finally:
+                    if response.background is not None:
+                        for task in response.background:
+                            await background_tasks.put(*task)
+
+        # Compile any query param parsers into a single validator function.
+        query_param_validator = (
+            None if query_param_parser_map is None
+            else compile_query_param_parser_map(query_param_parser_map)
+        )
 
         # Register this wrapper for the path.
-        _routes.append((path_regex, methods, query_param_parser_map, wrapper))
+        _routes.append((path_regex, methods, query_param_validator, wrapper))
         return wrapper
 
     return decorator
 
-async def dispatch(request):
-    """Attempt to find and invoke the handler for the specified request path
-    and return a bool indicating whether a handler was found.
+def _find_route(request):
+    """Return the (query_param_validator, func) of the first route that
+    matches the request path and method, or an error response if there's
+    none.
     """
     any_path_matches = False
-    for regex, methods, query_param_parser_map, func in _routes:
+    for regex, methods, query_param_validator, func in _routes:
         match = regex.match(request.path)
         any_path_matches |= match is not None
         if match and request.method in methods:
-            if query_param_parser_map is None:
-                await func(request)
-                return
-            ok_params, bad_params = parse_query_params(
-                request,
-                query_param_parser_map
-            )
-            if not bad_params:
-                await func(request, **ok_params)
-            else:
-                await send(
-                    request.writer,
-                    _400('invalid params: {}'.format(bad_params))
-                )
-            return
-
+            return query_param_validator, func
     if any_path_matches:
-        # Send a Method-Not-Allowed response if any path matched.
-        await send(request.writer, _405())
+        # Respond with Method-Not-Allowed if any path matched.
+        return _405()
+    # Otherwise, respond with Not-Found.
+    return _404()
+
+async def dispatch(request):
+    """Attempt to find and invoke the handler for the specified request path
+    and return a bool indicating whether a handler was found.
+    """
+    with trace_span('dispatch'):
+        found = None if rate_limiter is None else rate_limiter.check(request)
+        if found is None:
+            found = _find_route(request)
+        if not isinstance(found, Response):
+            query_param_validator, func = found
+            ok_params, bad_params = {}, None
+            if query_param_validator is not None:
+                ok_params, bad_params = query_param_validator(request.query)
+            if bad_params:
+                found = _400('invalid params: {}'.format(bad_params))
+
+    if isinstance(found, Response):
+        await send(request.writer, found)
     else:
-        # Otherwise, send a Not-Found respose.
-        await send(request.writer, _404())
+        await func(request, **ok_params)
 
 ###############################################################################
 # Request Handler Decorators
@@ -548,7 +1926,7 @@ def event_source(func):
             writer.write(
                 f'data: {json.dumps(data)}\n\n'.encode('utf-8')
             )
-            await writer.drain()
+            await drain(writer)
         return await func(request, sender, *args, **kwargs)
     return wrapper
 
@@ -577,6 +1955,164 @@ def json_response(func):
         return response
     return wrapper
 
+def in_process_pool(timeout=None):
+    """A request handler decorator that runs a CPU-bound, synchronous handler in
+    the process pool. The handler is passed the same arguments as a normal
+    handler except for the request, all of which must be picklable, and must
+    return a picklable Response. A 503 response is returned if the handler
+    takes longer than timeout seconds.
+
+    Since the decorated name is bound to the wrapper, the handler is
+    registered in its module under an alias derived from its __qualname__,
+    and its __qualname__ is permanently changed to the alias so that it's
+    pickled by it. A ValueError is raised if another function is already
+    registered under the same alias.
+    """
+    def decorator(func):
+        module = sys.modules[func.__module__]
+        if getattr(module, func.__qualname__, None) is func:
+            # The handler was already registered, or isn't rebound.
+            alias = func.__qualname__
+        else:
+            alias = '_in_process_pool_{}'.format(
+                re.sub(r'\W', '_', func.__qualname__)
+            )
+            if hasattr(module, alias):
+                raise ValueError(
+                    'Another in_process_pool handler is registered as {}.{}'
+                    .format(func.__module__, alias)
+                )
+            func.__qualname__ = alias
+            setattr(module, alias, func)
+
+        async def wrapper(request, *args, **kwargs):
+            try:
+                return await process_pool.run(func, args, kwargs, timeout)
+            except asyncio.TimeoutError:
+                return _503('Timed out after {} seconds'.format(timeout))
+        return wrapper
+    return decorator
+
+###############################################################################
+# Response Caching
+###############################################################################
+
+# Define a module-level variable to store the ResponseCache instance of each
+# function decorated with @cached_response.
+_response_caches = []
+
+class ResponseCache:
+    """A bounded LRU cache of serialized (<status_int>, <headers>, <body>)
+    responses with per-entry expiry and coalescing of concurrent misses.
+    """
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Map keys to (<expires_at>, <entry>) tuples in least to most recently
+        # used order.
+        self.entries = OrderedDict()
+        # Map keys to the Future of an in-progress computation.
+        self.pending = {}
+
+    def get(self, key):
+        item = self.entries.get(key)
+        if item is None:
+            return None
+        expires_at, entry = item
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def set(self, key, entry):
+        self.entries[key] = (time.monotonic() + self.ttl, entry)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, path_pattern=None):
+        """Remove all entries, or only those whose path matches the specified
+        regex pattern.
+        """
+        if path_pattern is None:
+            self.entries.clear()
+            return
+        regex = re.compile(path_pattern)
+        for key in [k for k in self.entries if regex.match(k[1])]:
+            del self.entries[key]
+
+def invalidate_cached_responses(path_pattern=None):
+    """Invalidate the entries of all @cached_response caches, or only those
+    whose path matches the specified regex pattern.
+    """
+    for cache in _response_caches:
+        cache.invalidate(path_pattern)
+
+def _serialize_response(response):
+    """Return a (<status_int>, <headers>, <body>) tuple for a Response with a
+    string or empty body, or None if the response can not be replayed.
+    """
+    if response is None or not (response.body is None or
+                                isinstance(response.body, str)):
+        return None
+    return response.status_int, list(response.headers.items()), response.body
+
+def _deserialize_response(entry):
+    status_int, headers, body = entry
+    return Response(status_int, headers=Headers(list(headers)), body=body)
+
+def cached_response(ttl=5, vary=(), max_entries=128):
+    """A request handler decorator that caches successful GET responses for ttl
+    seconds, keyed by method, path, query, and the values of the request
+    headers named in vary. Concurrent requests for the same key share a single
+    invocation of the handler.
+    """
+    vary = tuple(k.lower() for k in vary)
+    def decorator(func):
+        cache = ResponseCache(ttl, max_entries)
+        _response_caches.append(cache)
+
+        async def wrapper(request, *args, **kwargs):
+            if request.method != GET:
+                return await func(request, *args, **kwargs)
+
+            key = (
+                request.method,
+                request.path,
+                tuple(sorted(request.query.items(), key=lambda kv: kv[0])),
+                tuple(request.headers.get(k) for k in vary),
+            )
+            entry = cache.get(key)
+            if entry is not None:
+                return _deserialize_response(entry)
+
+            # Wait on any in-progress computation for the same key.
+            future = cache.pending.get(key)
+            if future is not None:
+                entry = await asyncio.shield(future)
+                if entry is not None:
+                    return _deserialize_response(entry)
+                # The response could not be shared, so compute our own.
+                return await func(request, *args, **kwargs)
+
+            future = asyncio.get_event_loop().create_future()
+            cache.pending[key] = future
+            entry = None
+            try:
+                response = await func(request, *args, **kwargs)
+                entry = _serialize_response(response)
+                if entry is not None and entry[0] == 200:
+                    cache.set(key, entry)
+                return response
+            finally:
+                del cache.pending[key]
+                future.set_result(entry)
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
 ###############################################################################
 # CLI
 ###############################################################################
@@ -585,4 +2121,8 @@ def json_response(func):
 if __name__ == '__main__':
     event_loop = asyncio.get_event_loop()
     event_loop.create_task(serve())
-    event_loop.run_forever()
+    try:
+        event_loop.run_forever()
+    except KeyboardInterrupt:
+        # Give any queued background tasks a chance to complete.
+        event_loop.run_until_complete(background_tasks.shutdown(timeout=10))
@@ -1,8 +1,19 @@
 
+import argparse
 import asyncio
 
 from femtoweb import filesystem_endpoints
-from femtoweb.server import serve
+from femtoweb.server import (
+    LISTEN_BACKLOG,
+    PROTOCOL_ENGINE,
+    STREAMS_ENGINE,
+    TRACE_SAMPLE_RATE,
+    TRACE_SLOW_THRESHOLD_SECONDS,
+    background_tasks,
+    enable_tracing,
+    serve,
+    systemd_listen_fds,
+)
 
 ###############################################################################
 # event_source decorator example
@@ -19,6 +30,8 @@ from femtoweb.server import (
 @route('/events', methods=(GET,))
 @event_source
 async def events(request, emitter):
+    # Emit until the client disconnects, at which point the server will
+    # cancel this handler.
     n = 0
     while True:
         await emitter(n)
@@ -48,7 +61,48 @@ async def get_time(request):
 ###############################################################################
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix-socket', dest='path',
+                        help='listen on a Unix socket at this path')
+    parser.add_argument('--unix-socket-mode', dest='path_mode',
+                        type=lambda s: int(s, 8),
+                        help='the octal permissions of the Unix socket')
+    parser.add_argument('--fd', type=int,
+                        help='listen on this already-open socket')
+    parser.add_argument('--systemd', action='store_true',
+                        help='listen on the socket passed by systemd')
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG)
+    parser.add_argument('--no-tcp-nodelay', dest='tcp_nodelay',
+                        action='store_false')
+    parser.add_argument('--rcvbuf', type=int)
+    parser.add_argument('--sndbuf', type=int)
+    parser.add_argument('--engine', default=STREAMS_ENGINE,
+                        choices=(STREAMS_ENGINE, PROTOCOL_ENGINE))
+    parser.add_argument('--trace', dest='trace_path',
+                        help='write sampled request traces to this file')
+    parser.add_argument('--trace-sample-rate', type=float,
+                        default=TRACE_SAMPLE_RATE)
+    parser.add_argument('--trace-slow-threshold', type=float,
+                        default=TRACE_SLOW_THRESHOLD_SECONDS)
+    args = parser.parse_args()
+    if args.trace_path is not None:
+        enable_tracing(args.trace_path, sample_rate=args.trace_sample_rate,
+                       slow_threshold=args.trace_slow_threshold)
+    del args.trace_path, args.trace_sample_rate, args.trace_slow_threshold
+    if args.systemd:
+        fds = systemd_listen_fds()
+        if not fds:
+            parser.error('No sockets were passed by systemd')
+        args.fd = fds[0]
+    del args.systemd
+
     filesystem_endpoints.attach()
     event_loop = asyncio.get_event_loop()
-    event_loop.create_task(serve())
-    event_loop.run_forever()
+    event_loop.run_until_complete(serve(**vars(args)))
+    try:
+        event_loop.run_forever()
+    except KeyboardInterrupt:
+        # Give any queued background tasks a chance to complete.
+        event_loop.run_until_complete(background_tasks.shutdown(timeout=10))
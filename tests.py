@@ -1,14 +1,68 @@
 
+import asyncio
+import hashlib
+import io
+import json
+import os
+import socket
+import struct
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
 from unittest import TestCase
 
 from femtoweb import server
+from femtoweb import filesystem_endpoints as server_fs
+from femtoweb.filesystem_endpoints import filesystem
+from femtoweb.filesystem_views import Template
+from femtoweb.multipart import MultipartParser, multipart_request, parse_form
+from femtoweb.proxy import proxy_route
 from femtoweb.server import (
+    ChunkStream,
+    GET,
+    TaskQueue,
     CouldNotParse,
+    ErrorResponse,
+    POST,
+    PROTOCOL_ENGINE,
+    PUT,
+    PayloadTooLarge,
+    RateLimiter,
+    Query,
+    Request,
+    RequestTimeout,
+    Response,
+    STREAMS_ENGINE,
+    Timeouts,
+    _200,
+    _303,
+    _404,
+    as_bounded_int,
     as_choice,
+    as_list,
     as_nonempty,
     as_type,
+    cached_response,
+    compile_query_param_parser_map,
+    disable_tracing,
+    enable_tracing,
     get_file_path_content_type,
+    in_process_pool,
+    invalidate_cached_responses,
+    json_response,
     maybe_as,
+    metrics,
+    on_disconnect,
+    parse_request,
+    parse_uri,
+    process_pool,
+    read_body,
+    route,
+    serve,
+    systemd_listen_fds,
+    trace_span,
     with_default_as,
 )
 
@@ -118,6 +172,68 @@ class Tester(TestCase):
                 self.assertEqual(parser(a), b)
 
 
+    def test_as_bounded_int(self):
+        parser = as_bounded_int(0, 10)
+        for a, b in (
+                (None, CouldNotParse),
+                ('', CouldNotParse),
+                ('-1', CouldNotParse),
+                ('0', 0),
+                ('10', 10),
+                ('11', CouldNotParse),
+                ('a', CouldNotParse),
+            ):
+            if b is CouldNotParse:
+                self.assertRaises(CouldNotParse, parser, a)
+            else:
+                self.assertEqual(parser(a), b)
+
+
+    def test_as_list(self):
+        parser = as_list(as_type(int), sep=',', max_len=3)
+        for a, b in (
+                (None, []),
+                ([], []),
+                (['1'], [1]),
+                (['1', '2,3'], [1, 2, 3]),
+                (['1', '2,3', '4'], CouldNotParse),
+                (['a'], CouldNotParse),
+            ):
+            if b is CouldNotParse:
+                self.assertRaises(CouldNotParse, parser, a)
+            else:
+                self.assertEqual(parser(a), b)
+
+
+    def test_parse_uri(self):
+        path, query = parse_uri('/a%20b?x=1&y=a+b%26c&x=2&z&q=what?')
+        self.assertEqual(path, '/a%20b')
+        self.assertEqual(query.get('x'), '2')
+        self.assertEqual(query.get_all('x'), ['1', '2'])
+        self.assertEqual(query['y'], 'a b&c')
+        self.assertIn('z', query)
+        self.assertIsNone(query['z'])
+        self.assertEqual(query.get('q'), 'what?')
+        self.assertIsNone(query.get('missing'))
+        self.assertEqual(parse_uri('/')[1].params, {})
+
+
+    def test_compile_query_param_parser_map(self):
+        validate = compile_query_param_parser_map({
+            'n': as_bounded_int(1, 5),
+            'tags': with_default_as(as_list(as_nonempty(as_type(str))), []),
+            'mode': maybe_as(as_choice('a', 'b')),
+        })
+        self.assertEqual(
+            validate(parse_uri('/?n=2&tags=x&tags=y')[1]),
+            ({'n': 2, 'tags': ['x', 'y'], 'mode': None}, {})
+        )
+        self.assertEqual(
+            validate(parse_uri('/?n=9&tags=&mode=c')[1]),
+            ({'tags': []}, {'n': '9', 'mode': 'c'})
+        )
+
+
     def test_get_file_path_content_type(self):
         for a, b in (
                 ('', server.APPLICATION_OCTET_STREAM),
@@ -135,3 +251,1336 @@ class Tester(TestCase):
                 ('test.txt', server.TEXT_PLAIN),
             ):
             self.assertEqual(get_file_path_content_type(a), b)
+
+
+class TimeoutTester(TestCase):
+    def setUp(self):
+        self._timeouts = server.TIMEOUTS
+        server.TIMEOUTS = Timeouts(request_line=0.05, headers=0.05, body=0.05)
+
+    def tearDown(self):
+        server.TIMEOUTS = self._timeouts
+
+    def test_request_line_timeout(self):
+        async def f():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'GET / HT')
+            await parse_request(reader, None)
+        self.assertRaises(RequestTimeout, asyncio.run, f())
+
+    def test_headers_timeout(self):
+        async def f():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'GET / HTTP/1.1\r\nhost: x\r\n')
+            await parse_request(reader, None)
+        self.assertRaises(RequestTimeout, asyncio.run, f())
+
+    def test_body_timeout(self):
+        async def f():
+            reader = asyncio.StreamReader()
+            reader.feed_data(
+                b'PUT / HTTP/1.1\r\ncontent-length: 10\r\n\r\n12345'
+            )
+            request = await parse_request(reader, None)
+            return [chunk async for chunk in read_body(request)]
+        self.assertRaises(RequestTimeout, asyncio.run, f())
+
+    def test_body_complete(self):
+        async def f():
+            reader = asyncio.StreamReader()
+            reader.feed_data(
+                b'PUT / HTTP/1.1\r\ncontent-length: 5\r\n\r\n12345'
+            )
+            request = await parse_request(reader, None)
+            return [chunk async for chunk in read_body(request, 2)]
+        self.assertEqual(asyncio.run(f()), [b'12', b'34', b'5'])
+
+
+def make_request(method='GET', path='/', query=None, headers=None):
+    return Request(
+        reader=None,
+        writer=None,
+        method=method,
+        url=path,
+        path=path,
+        query=query or {},
+        headers=headers or {},
+        body=None,
+    )
+
+
+class CachedResponseTester(TestCase):
+    def test_coalesces_and_caches(self):
+        calls = []
+
+        @cached_response(ttl=60)
+        @json_response
+        async def handler(request):
+            calls.append(request)
+            await asyncio.sleep(0.01)
+            return _200(body={'n': len(calls)})
+
+        async def f():
+            responses = await asyncio.gather(
+                *(handler(make_request(path='/a')) for _ in range(5))
+            )
+            responses.append(await handler(make_request(path='/a')))
+            return responses
+
+        responses = asyncio.run(f())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual({r.body for r in responses}, {'{"n": 1}'})
+        self.assertEqual(responses[-1].headers['content-type'],
+                         'application/json')
+
+    def test_key_and_invalidation(self):
+        calls = []
+
+        @cached_response(ttl=60, vary=('Accept',))
+        async def handler(request):
+            calls.append(request)
+            return _200(body='ok')
+
+        async def f(**kwargs):
+            return await handler(make_request(**kwargs))
+
+        asyncio.run(f(path='/a'))
+        asyncio.run(f(path='/a'))
+        self.assertEqual(len(calls), 1)
+        asyncio.run(f(path='/a', query={'x': '1'}))
+        asyncio.run(f(path='/a', headers={'accept': 'text/plain'}))
+        asyncio.run(f(path='/a', method='PUT'))
+        self.assertEqual(len(calls), 4)
+        invalidate_cached_responses('/a')
+        asyncio.run(f(path='/a'))
+        self.assertEqual(len(calls), 5)
+
+
+class TemplateTester(TestCase):
+    def test_render(self):
+        template = Template(
+            '<p title="{{title}}">{{text}}</p><script>f({{arg|js}})</script>'
+        )
+        self.assertEqual(
+            b''.join(template.render(
+                title='"x"',
+                text=iter(('a<', 'b&')),
+                arg='</script>',
+            )),
+            b'<p title="&quot;x&quot;">a&lt;b&amp;</p>'
+            b'<script>f("<\\/script>")</script>'
+        )
+
+    def test_chunk_stream(self):
+        stream = ChunkStream((b'abc', b'', b'defgh', b'i'))
+        buf = bytearray(4)
+        chunks = []
+        while True:
+            num_bytes = stream.readinto(buf)
+            if not num_bytes:
+                break
+            chunks.append(bytes(buf[:num_bytes]))
+        self.assertEqual(chunks, [b'abcd', b'efgh', b'i'])
+
+
+@route('/_test/echo', methods=(PUT,))
+async def _test_echo(request):
+    body = b''.join([chunk async for chunk in read_body(request, 4096)])
+    return _200(body='{} {}'.format(request.query.get('x'), len(body)))
+
+def _broken_chunks():
+    yield b'partial'
+    raise OSError('Gone')
+
+@route('/_test/broken', methods=(GET,))
+async def _test_broken(request):
+    return _200(body=ChunkStream(_broken_chunks()))
+
+
+class EngineTester(TestCase):
+    async def _request(self, port, data):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(data)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        return response
+
+    def _test_engine(self, engine):
+        async def f():
+            server = await serve('127.0.0.1', 0, engine=engine)
+            port = server.sockets[0].getsockname()[1]
+            body = b'x' * 100000
+            try:
+                return await asyncio.gather(
+                    self._request(port, (
+                        b'PUT /_test/echo?x=a%20b HTTP/1.1\r\n'
+                        b'content-length: 100000\r\n\r\n' + body
+                    )),
+                    self._request(port, b'GET /_test/missing HTTP/1.1\r\n\r\n'),
+                    self._request(port, b'GET /_test/echo HTTP/1.1\r\n\r\n'),
+                )
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        ok, not_found, not_allowed = asyncio.run(f())
+        self.assertTrue(ok.startswith(b'HTTP/1.1 200'))
+        self.assertTrue(ok.endswith(b'\n\na b 100000'))
+        self.assertTrue(not_found.startswith(b'HTTP/1.1 404'))
+        self.assertTrue(not_allowed.startswith(b'HTTP/1.1 405'))
+
+    def test_streams_engine(self):
+        self._test_engine(STREAMS_ENGINE)
+
+    def test_protocol_engine(self):
+        self._test_engine(PROTOCOL_ENGINE)
+
+    def test_incomplete_response(self):
+        # A body that fails after the head was sent aborts the connection
+        # instead of appending an error response to the partial body.
+        for engine in (STREAMS_ENGINE, PROTOCOL_ENGINE):
+            async def f():
+                server = await serve('127.0.0.1', 0, engine=engine)
+                port = server.sockets[0].getsockname()[1]
+                try:
+                    return await self._request(
+                        port, b'GET /_test/broken HTTP/1.1\r\n\r\n'
+                    )
+                finally:
+                    server.close()
+                    await server.wait_closed()
+
+            aborted_responses = metrics['aborted_responses']
+            response = asyncio.run(f())
+            self.assertTrue(response.startswith(b'HTTP/1.1 200'))
+            self.assertEqual(response.count(b'HTTP/1.1'), 1)
+            self.assertNotIn(b'Server Error', response)
+            self.assertEqual(metrics['aborted_responses'],
+                             aborted_responses + 1)
+
+
+class TracingTester(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'trace.json')
+
+    def tearDown(self):
+        disable_tracing()
+        self.tmp.cleanup()
+
+    def _requests(self, *paths, **kwargs):
+        tracer = enable_tracing(self.path, **kwargs)
+        async def f():
+            server = await serve('127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                for path in paths:
+                    reader, writer = await asyncio.open_connection(
+                        '127.0.0.1', port
+                    )
+                    writer.write(
+                        'PUT {} HTTP/1.1\r\ncontent-length: 1\r\n\r\nx'
+                        .format(path).encode()
+                    )
+                    await reader.read()
+                    writer.close()
+            finally:
+                server.close()
+                await server.wait_closed()
+        asyncio.run(f())
+        tracer.close()
+        return tracer
+
+    def _events(self, path=None):
+        with open(path or self.path) as fh:
+            text = fh.read()
+        # The file is an unterminated JSON array.
+        return json.loads(text.rstrip().rstrip(',') + ']')
+
+    def test_sampled(self):
+        self._requests('/_test/echo', '/_test/missing', sample_rate=1)
+        events = self._events()
+        requests = [e for e in events if e['name'] == 'request']
+        self.assertEqual([e['args']['path'] for e in requests],
+                         ['/_test/echo', '/_test/missing'])
+        spans = [e for e in events if e['tid'] == requests[0]['tid']]
+        self.assertEqual(
+            {e['name'] for e in spans},
+            {'thread_name', 'request', 'parse_request', 'dispatch',
+             'handler', 'send', 'drain'}
+        )
+        request = requests[0]
+        for e in spans:
+            if e['ph'] == 'X':
+                self.assertGreaterEqual(e['ts'], request['ts'])
+                self.assertLessEqual(e['ts'] + e['dur'],
+                                     request['ts'] + request['dur'] + 1)
+        send, = (e for e in spans if e['name'] == 'send')
+        self.assertEqual(send['args'], {'status': 200})
+
+    def test_unsampled(self):
+        tracer = self._requests('/_test/echo', sample_rate=0)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(tracer.written, 0)
+
+    def test_slow_requests_are_always_traced(self):
+        tracer = self._requests('/_test/echo', sample_rate=0,
+                                slow_threshold=0)
+        self.assertEqual(tracer.written, 1)
+
+    def test_rotation(self):
+        self._requests(*['/_test/echo'] * 3, sample_rate=1,
+                       max_file_bytes=1, backup_count=1)
+        self.assertEqual(len(self._events(self.path + '.1')), 8)
+        self.assertEqual(len(self._events()), 8)
+        self.assertFalse(os.path.exists(self.path + '.2'))
+
+    def test_no_trace(self):
+        with trace_span('x') as span:
+            self.assertIsNone(span)
+
+    def test_filesystem_spans(self):
+        async def f():
+            trace = server.Trace(1)
+            server._current_trace.set(trace)
+            request = make_request(path='/_fs/a.txt', query=Query(''))
+            response = await filesystem(request, self.tmp.name)
+            response.body.close()
+            return trace
+        with open(os.path.join(self.tmp.name, 'a.txt'), 'w') as fh:
+            fh.write('a')
+        trace = asyncio.run(f())
+        self.assertEqual(
+            [(name, args) for name, _, _, args in trace.spans],
+            [('fs.stat', {'path': 'a.txt'}), ('fs.open', {'path': 'a.txt'})]
+        )
+
+
+class FakeWriter:
+    def __init__(self, peername):
+        self.peername = peername
+
+    def get_extra_info(self, name, default=None):
+        return self.peername if name == 'peername' else default
+
+
+class RateLimiterTester(TestCase):
+    def _request(self, host='10.0.0.1', port=1234, headers=None):
+        return make_request(headers=headers)._replace(
+            writer=FakeWriter((host, port))
+        )
+
+    def test_invalid_arguments(self):
+        for kwargs in ({'rate': 0}, {'rate': -1}, {'rate': 1, 'burst': 0.5}):
+            with self.assertRaises(ValueError):
+                RateLimiter(**kwargs)
+
+    def test_burst_and_refill(self):
+        limiter = RateLimiter(rate=10, burst=3)
+        request = self._request()
+        self.assertEqual(
+            [limiter.check(request) for _ in range(3)], [None] * 3
+        )
+        response = limiter.check(request)
+        self.assertEqual(response.status_int, 429)
+        self.assertEqual(response.headers['retry-after'], '1')
+        self.assertEqual(limiter.limited, 1)
+        # Other clients are unaffected, regardless of port.
+        self.assertIsNone(limiter.check(self._request('10.0.0.2')))
+        self.assertIsNotNone(limiter.check(self._request(port=5678)))
+        # A token is added every 0.1 seconds.
+        time.sleep(0.11)
+        self.assertIsNone(limiter.check(request))
+        self.assertIsNotNone(limiter.check(request))
+
+    def test_retry_after(self):
+        limiter = RateLimiter(rate=0.1)
+        self.assertEqual(limiter.acquire('a'), 0)
+        self.assertAlmostEqual(limiter.acquire('a'), 10, places=1)
+
+    def test_key_header(self):
+        limiter = RateLimiter(rate=1, key_header='x-device-id')
+        for device_id in ('a', 'b'):
+            self.assertIsNone(limiter.check(
+                self._request(headers={'x-device-id': device_id})
+            ))
+        self.assertIsNotNone(limiter.check(
+            self._request(headers={'x-device-id': 'a'})
+        ))
+        # Fall back to the client address.
+        self.assertIsNone(limiter.check(self._request()))
+        self.assertEqual(set(limiter.buckets), {'a', 'b', '10.0.0.1'})
+
+    def test_lru_eviction(self):
+        limiter = RateLimiter(rate=1, max_clients=2)
+        for key in ('a', 'b', 'a', 'c'):
+            limiter.acquire(key)
+        self.assertEqual(list(limiter.buckets), ['a', 'c'])
+
+    def test_route_and_server_limits(self):
+        @route('/_test/rate_limited', methods=(GET,),
+               rate_limit=RateLimiter(rate=1, burst=2))
+        async def rate_limited(request):
+            return _200(body='ok')
+
+        async def request(port, path):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write('GET {} HTTP/1.1\r\n\r\n'.format(path).encode())
+            response = await reader.read()
+            writer.close()
+            return response.split(b' ', 2)[1]
+
+        async def f(rate_limit, paths):
+            http_server = await serve('127.0.0.1', 0, rate_limit=rate_limit)
+            port = http_server.sockets[0].getsockname()[1]
+            try:
+                return [await request(port, path) for path in paths]
+            finally:
+                http_server.close()
+                await http_server.wait_closed()
+                # Remove the server-wide limit.
+                server.rate_limiter = None
+
+        self.assertEqual(
+            asyncio.run(f(None, ['/_test/rate_limited'] * 3 +
+                          ['/_test/missing'] * 3)),
+            [b'200', b'200', b'429', b'404', b'404', b'404']
+        )
+        self.assertEqual(
+            asyncio.run(f(RateLimiter(rate=1, burst=2),
+                          ['/_test/missing'] * 3)),
+            [b'404', b'404', b'429']
+        )
+
+
+class ListenerTester(TestCase):
+    async def _get(self, server, open_connection):
+        try:
+            reader, writer = await open_connection()
+            writer.write(b'GET /_test/missing HTTP/1.1\r\n\r\n')
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+            return response
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    def test_unix_socket(self):
+        async def f(engine):
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'femtoweb.sock')
+                server = await serve(path=path, path_mode=0o600,
+                                     engine=engine)
+                self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+                return await self._get(
+                    server, lambda: asyncio.open_unix_connection(path)
+                )
+        for engine in (STREAMS_ENGINE, PROTOCOL_ENGINE):
+            self.assertTrue(asyncio.run(f(engine)).startswith(
+                b'HTTP/1.1 404'
+            ))
+
+    def test_inherited_fd(self):
+        async def f():
+            sock = socket.socket()
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+            server = await serve(fd=sock.detach(), tcp_nodelay=False,
+                                 rcvbuf=65536)
+            return await self._get(
+                server, lambda: asyncio.open_connection('127.0.0.1', port)
+            )
+        self.assertTrue(asyncio.run(f()).startswith(b'HTTP/1.1 404'))
+
+    def test_multiple_listeners(self):
+        with self.assertRaises(ValueError):
+            asyncio.run(serve(path='/tmp/femtoweb.sock', fd=3))
+
+    def test_systemd_listen_fds(self):
+        env = dict(os.environ)
+        try:
+            os.environ.update(LISTEN_PID=str(os.getpid()), LISTEN_FDS='2')
+            self.assertEqual(systemd_listen_fds(), [3, 4])
+            os.environ['LISTEN_PID'] = '1'
+            self.assertEqual(systemd_listen_fds(), [])
+        finally:
+            os.environ.clear()
+            os.environ.update(env)
+
+
+class ResponseTester(TestCase):
+    def test_default_headers(self):
+        response = _404()
+        self.assertEqual(
+            response.encode_head(),
+            b'HTTP/1.1 404 OK\ncontent-type: text/plain\nconnection: close\n'
+            b'access-control-allow-origin: *\n\n'
+        )
+        self.assertEqual(response.body, '404 Not Found')
+        # Modifying the headers of one response must not affect others.
+        response.headers['x-test'] = '1'
+        self.assertIn(b'x-test: 1\n', response.encode_head())
+        self.assertNotIn(b'x-test', _404().encode_head())
+
+    def test_argument_headers(self):
+        response = _303('/a')
+        self.assertEqual(response.headers['location'], '/a')
+        self.assertEqual(response.headers['content-type'], 'text/html')
+        response = _200(headers={'content-type': 'text/plain'})
+        self.assertEqual(response.headers.get_all('content-type', None),
+                         ['text/plain'])
+
+    def test_class_attribute_headers_and_body(self):
+        class JSONResponse(Response):
+            status_int = 200
+            headers = {'content-type': 'application/json'}
+
+        class _418(ErrorResponse):
+            status_int = 418
+            body = "I'm a teapot"
+
+        response = JSONResponse()
+        self.assertIn(b'content-type: application/json\n',
+                      response.encode_head())
+        self.assertEqual(response.headers['content-type'], 'application/json')
+        response = JSONResponse(headers={'x-test': '1'})
+        self.assertIn(b'content-type: application/json\n',
+                      response.encode_head())
+        self.assertEqual(_418().body, "418 I'm a teapot")
+        self.assertEqual(_418('short').body, "418 I'm a teapot - short")
+
+        with self.assertRaises(TypeError):
+            class BodyResponse(Response):
+                body = 'x'
+
+
+class TaskQueueTester(TestCase):
+    def test_retry_and_shutdown(self):
+        calls = []
+
+        async def flaky(name):
+            calls.append(name)
+            if calls.count(name) < 3:
+                raise ValueError
+
+        async def f():
+            queue = TaskQueue(max_size=2, num_workers=1, max_retries=2,
+                              retry_backoff=0.001)
+            await queue.put(flaky, ('a',))
+            await queue.put(flaky, ('b',))
+            await queue.put(flaky, ('c',), {})
+            await queue.shutdown()
+            return queue.stats()
+
+        stats = asyncio.run(f())
+        self.assertEqual(calls, ['a', 'a', 'a', 'b', 'b', 'b', 'c', 'c', 'c'])
+        self.assertEqual(stats['completed'], 3)
+        self.assertEqual(stats['retried'], 6)
+        self.assertEqual(stats['failed'], 0)
+        self.assertEqual(stats['depth'], 0)
+
+    def test_workers_do_not_inherit_context(self):
+        traces = []
+
+        async def record():
+            traces.append(server._current_trace.get())
+
+        async def f():
+            queue = TaskQueue(num_workers=1)
+            token = server._current_trace.set('request-trace')
+            try:
+                await queue.put(record)
+            finally:
+                server._current_trace.reset(token)
+            await queue.put(record)
+            await queue.shutdown()
+
+        asyncio.run(f())
+        self.assertEqual(traces, [None, None])
+
+    def test_give_up(self):
+        async def fail():
+            raise ValueError
+
+        async def f():
+            queue = TaskQueue(max_retries=1, retry_backoff=0.001)
+            await queue.put(fail)
+            await queue.shutdown()
+            return queue.stats()
+
+        stats = asyncio.run(f())
+        self.assertEqual((stats['failed'], stats['retried']), (1, 1))
+
+
+@json_response
+@in_process_pool(timeout=5)
+def _test_spin(seconds):
+    end = time.time() + seconds
+    n = 0
+    while time.time() < end:
+        n += 1
+    return _200(body={'n': n > 0})
+
+
+class InProcessPoolTester(TestCase):
+    def tearDown(self):
+        process_pool.shutdown()
+
+    def test_event_loop_latency(self):
+        async def f():
+            # Measure the max event loop latency while CPU-bound handlers run.
+            max_latency = 0
+            async def ticker():
+                nonlocal max_latency
+                while True:
+                    start = time.monotonic()
+                    await asyncio.sleep(0.01)
+                    max_latency = max(max_latency,
+                                      time.monotonic() - start - 0.01)
+            # Start the pool workers before measuring.
+            await _test_spin(make_request(), 0)
+            ticker_task = asyncio.get_event_loop().create_task(ticker())
+            responses = await asyncio.gather(
+                *(_test_spin(make_request(), 0.5) for _ in range(2))
+            )
+            ticker_task.cancel()
+            return responses, max_latency
+
+        responses, max_latency = asyncio.run(f())
+        self.assertEqual([r.body for r in responses], ['{"n": true}'] * 2)
+        self.assertLess(max_latency, 0.1)
+
+    def test_timeout(self):
+        handler = in_process_pool(timeout=0.1)(_spin_forever)
+        response = asyncio.run(handler(make_request(), 1))
+        self.assertEqual(response.status_int, 503)
+
+    def test_alias_collision(self):
+        def make_handler():
+            def handler():
+                return _200()
+            return handler
+        handler = make_handler()
+        in_process_pool()(handler)
+        try:
+            self.assertIs(getattr(sys.modules[__name__],
+                                  handler.__qualname__), handler)
+            with self.assertRaises(ValueError):
+                in_process_pool()(make_handler())
+        finally:
+            delattr(sys.modules[__name__], handler.__qualname__)
+
+
+def _spin_forever(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+_test_abandoned = []
+
+@route('/_test/slow', methods=(GET,))
+async def _test_slow(request):
+    try:
+        await asyncio.sleep(10)
+    except asyncio.CancelledError:
+        _test_abandoned.append('cancelled')
+        raise
+    return _200()
+
+@route('/_test/delayed', methods=(GET,))
+async def _test_delayed(request):
+    await asyncio.sleep(0.05)
+    return _200(body='ok')
+
+@on_disconnect
+async def _test_on_disconnect(request):
+    if request.path == '/_test/slow':
+        _test_abandoned.append('hook')
+
+
+class DisconnectTester(TestCase):
+    def _test_engine(self, engine):
+        del _test_abandoned[:]
+        abandoned_requests = metrics['abandoned_requests']
+
+        async def f():
+            server = await serve('127.0.0.1', 0, engine=engine)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                               port)
+                writer.write(b'GET /_test/slow HTTP/1.1\r\n\r\n')
+                await writer.drain()
+                await asyncio.sleep(0.05)
+                # Reset the connection.
+                writer.get_extra_info('socket').setsockopt(
+                    socket.SOL_SOCKET, socket.SO_LINGER,
+                    struct.pack('ii', 1, 0)
+                )
+                writer.close()
+                await asyncio.sleep(0.05)
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        asyncio.run(f())
+        self.assertEqual(_test_abandoned, ['cancelled', 'hook'])
+        self.assertEqual(metrics['abandoned_requests'], abandoned_requests + 1)
+
+    def _test_half_close(self, engine):
+        async def f():
+            server = await serve('127.0.0.1', 0, engine=engine)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                               port)
+                writer.write(b'GET /_test/delayed HTTP/1.1\r\n\r\n')
+                writer.write_eof()
+                response = await reader.read()
+                writer.close()
+                return response
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        response = asyncio.run(f())
+        self.assertTrue(response.startswith(b'HTTP/1.1 200'))
+        self.assertTrue(response.endswith(b'ok'))
+
+    def test_streams_engine(self):
+        self._test_engine(STREAMS_ENGINE)
+        self._test_half_close(STREAMS_ENGINE)
+
+    def test_protocol_engine(self):
+        self._test_engine(PROTOCOL_ENGINE)
+        self._test_half_close(PROTOCOL_ENGINE)
+
+
+def read_stream(stream):
+    buf = bytearray(1000)
+    data = b''
+    while True:
+        num_bytes = stream.readinto(buf)
+        if not num_bytes:
+            return data
+        data += buf[:num_bytes]
+
+
+class FilesystemTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        os.makedirs(os.path.join(self.root, 'dir', 'sub', 'empty'))
+        self.files = {
+            'a.txt': b'a' * 1000,
+            'sub/b.bin': bytes(range(256)) * 300,
+        }
+        for name, data in self.files.items():
+            with open(os.path.join(self.root, 'dir', name), 'wb') as fh:
+                fh.write(data)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _get(self, query):
+        request = make_request(path='/_fs/dir', query=Query(query))
+        return asyncio.run(filesystem(request, self.root))
+
+    def _put(self, req_path, data, query='archive=tar'):
+        async def f():
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            request = make_request(
+                method=PUT,
+                path='/_fs/' + req_path,
+                query=Query(query),
+                headers={'content-length': str(len(data))},
+            )
+            request = request._replace(reader=reader, body=reader)
+            return await filesystem(request, self.root)
+        return asyncio.run(f())
+
+
+class FilesystemArchiveTester(FilesystemTestCase):
+    def test_get_tar(self):
+        response = self._get('archive=tar')
+        data = read_stream(response.body)
+        self.assertEqual(len(data) % tarfile.RECORDSIZE, 0)
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            self.assertIn('sub/empty', tar.getnames())
+            for name, content in self.files.items():
+                self.assertEqual(tar.extractfile(name).read(), content)
+
+    def test_get_zip(self):
+        response = self._get('archive=zip')
+        self.assertEqual(response.headers['content-type'], 'application/zip')
+        data = read_stream(response.body)
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.assertIn('sub/empty/', zf.namelist())
+            for name, content in self.files.items():
+                self.assertEqual(zf.read(name), content)
+
+    def test_get_archive_read_error(self):
+        @route('/_fs/archive_read_error', methods=(GET,))
+        async def archive_read_error(request):
+            return await filesystem(
+                request._replace(path='/_fs/dir'), self.root
+            )
+
+        read_chunks = server_fs._read_chunks
+        def failing_read_chunks(fs_path, size):
+            # Fail like a file that was deleted after it was stat'd.
+            if fs_path.endswith('b.bin'):
+                raise FileNotFoundError(fs_path)
+            return read_chunks(fs_path, size)
+
+        async def f(archive):
+            server = await serve('127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', port
+                )
+                writer.write(
+                    'GET /_fs/archive_read_error?archive={} HTTP/1.1\r\n\r\n'
+                    .format(archive).encode()
+                )
+                response = await reader.read()
+                writer.close()
+                return response
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        for archive in ('tar', 'zip'):
+            full_size = len(read_stream(
+                self._get('archive={}'.format(archive)).body
+            ))
+            server_fs._read_chunks = failing_read_chunks
+            try:
+                response = asyncio.run(f(archive))
+            finally:
+                server_fs._read_chunks = read_chunks
+            self.assertTrue(response.startswith(b'HTTP/1.1 200'))
+            # The connection was aborted without an error response.
+            self.assertEqual(response.count(b'HTTP/1.1'), 1)
+            self.assertNotIn(b'Server Error', response)
+            data = response.partition(b'\r\n\r\n')[2]
+            self.assertLess(len(data), full_size)
+
+    def test_put_tar(self):
+        data = read_stream(self._get('archive=tar').body)
+        response = self._put('copy', data)
+        self.assertEqual(response.status_int, 303)
+        for name, content in self.files.items():
+            with open(os.path.join(self.root, 'copy', name), 'rb') as fh:
+                self.assertEqual(fh.read(), content)
+        # Replace the existing directory.
+        response = self._put('dir/sub', data)
+        self.assertEqual(response.status_int, 303)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.root, 'dir', 'sub'))),
+            ['a.txt', 'sub']
+        )
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, 'dir'))),
+                         ['a.txt', 'sub'])
+
+    def test_put_dot_rooted_tar(self):
+        # Like "tar -C dir -cf - .", whose first member is "./".
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            tar.add(os.path.join(self.root, 'dir'), arcname='.')
+        response = self._put('copy', buf.getvalue())
+        self.assertEqual(response.status_int, 303)
+        for name, content in self.files.items():
+            with open(os.path.join(self.root, 'copy', name), 'rb') as fh:
+                self.assertEqual(fh.read(), content)
+        response = self._put('dir', buf.getvalue(), 'archive=tar&merge=1')
+        self.assertEqual(response.status_int, 303)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, 'dir'))),
+                         ['a.txt', 'sub'])
+        # A non-directory member at the root is still rejected.
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            info = tarfile.TarInfo('.')
+            info.size = 4
+            tar.addfile(info, io.BytesIO(b'evil'))
+        self.assertEqual(self._put('copy2', buf.getvalue()).status_int, 400)
+
+    def test_put_tar_traversal(self):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            info = tarfile.TarInfo('../evil.txt')
+            info.size = 4
+            tar.addfile(info, io.BytesIO(b'evil'))
+        response = self._put('copy', buf.getvalue())
+        self.assertEqual(response.status_int, 400)
+        self.assertEqual(sorted(os.listdir(self.root)), ['dir'])
+        self.assertEqual(self._put('..', buf.getvalue()).status_int, 400)
+
+
+class FilesystemEditorTester(FilesystemTestCase):
+    def _get_edit(self, name):
+        request = make_request(path='/_fs/dir/' + name, query=Query('edit=1'))
+        return asyncio.run(filesystem(request, self.root))
+
+    def test_edit(self):
+        response = self._get_edit('a.txt')
+        self.assertEqual(response.status_int, 200)
+        self.assertIn(b'a' * 1000, read_stream(response.body))
+
+    def test_undecodable_file(self):
+        # The error is raised before a response is returned, so that the
+        # client receives a clean 500 response.
+        with open(os.path.join(self.root, 'dir', 'bad.txt'), 'wb') as fh:
+            fh.write(b'ok\xff\xfe')
+        self.assertRaises(UnicodeDecodeError, self._get_edit, 'bad.txt')
+
+
+class FilesystemManifestTester(FilesystemTestCase):
+    def _manifest(self):
+        async def f():
+            request = make_request(path='/_fs/dir', query=Query('manifest=1'))
+            return await filesystem(request, self.root, self.index_path)
+        response = asyncio.run(f())
+        return {x['path']: x for x in json.loads(response.body)['files']}
+
+    def setUp(self):
+        FilesystemTestCase.setUp(self)
+        self.index_path = os.path.join(self.root, 'index.json')
+
+    def test_manifest(self):
+        manifest = self._manifest()
+        self.assertEqual(set(manifest), set(self.files))
+        for name, content in self.files.items():
+            self.assertEqual(manifest[name]['size'], len(content))
+            self.assertEqual(manifest[name]['sha256'],
+                             hashlib.sha256(content).hexdigest())
+        with open(self.index_path) as fh:
+            self.assertEqual(len(json.load(fh)), len(self.files))
+
+    def test_stale_entries_are_pruned(self):
+        self._manifest()
+        # Replace a file with a new inode, delete another, and add one in a
+        # sibling directory that's outside of the manifest.
+        a_path = os.path.join(self.root, 'dir', 'a.txt')
+        with open(a_path + '.tmp', 'wb') as fh:
+            fh.write(b'new')
+        # Keep the old inode from being reused.
+        os.link(a_path, os.path.join(self.root, 'a.bak'))
+        os.replace(a_path + '.tmp', a_path)
+        os.remove(os.path.join(self.root, 'dir', 'sub', 'b.bin'))
+        os.makedirs(os.path.join(self.root, 'other'))
+        other_path = os.path.join(self.root, 'other', 'c.txt')
+        with open(other_path, 'wb') as fh:
+            fh.write(b'c')
+        hash_index = server_fs.get_hash_index(self.index_path)
+        hash_index.get_hash(other_path, os.stat(other_path))
+        hash_index.save()
+
+        self.assertEqual(set(self._manifest()), {'a.txt'})
+        with open(self.index_path) as fh:
+            entries = json.load(fh)
+        self.assertEqual(
+            sorted(entry[3] for entry in entries.values()),
+            [a_path, other_path]
+        )
+        st = os.stat(a_path)
+        self.assertIn('{}:{}'.format(st.st_dev, st.st_ino), entries)
+
+    def test_unchanged_files_are_not_rehashed(self):
+        self._manifest()
+        # Change the content of a file but not its size or mtime.
+        fs_path = os.path.join(self.root, 'dir', 'a.txt')
+        st = os.stat(fs_path)
+        with open(fs_path, 'r+b') as fh:
+            fh.write(b'b')
+        os.utime(fs_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(self._manifest()['a.txt']['sha256'],
+                         hashlib.sha256(self.files['a.txt']).hexdigest())
+        # Change its mtime.
+        os.utime(fs_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        self.assertEqual(
+            self._manifest()['a.txt']['sha256'],
+            hashlib.sha256(b'b' + self.files['a.txt'][1:]).hexdigest()
+        )
+
+    def test_merge(self):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            for name in ('sub/b.bin', 'new/c.txt'):
+                info = tarfile.TarInfo(name)
+                info.size = 3
+                tar.addfile(info, io.BytesIO(b'new'))
+        response = self._put('dir', buf.getvalue(), 'archive=tar&merge=1')
+        self.assertEqual(response.status_int, 303)
+        manifest = self._manifest()
+        self.assertEqual(set(manifest), {'a.txt', 'sub/b.bin', 'new/c.txt'})
+        self.assertEqual(manifest['sub/b.bin']['size'], 3)
+        self.assertEqual(manifest['a.txt']['size'], 1000)
+
+
+BOUNDARY = 'xYzZY'
+
+def encode_multipart(parts):
+    """Encode a list of (name, filename, data) parts as a multipart body.
+    """
+    chunks = [b'preamble']
+    for name, filename, data in parts:
+        disposition = 'form-data; name="{}"'.format(name)
+        if filename is not None:
+            disposition += '; filename="{}"'.format(filename)
+        chunks.append(
+            '\r\n--{}\r\nContent-Disposition: {}\r\n\r\n'.format(
+                BOUNDARY, disposition
+            ).encode('utf-8')
+        )
+        chunks.append(data)
+    chunks.append('\r\n--{}--\r\n'.format(BOUNDARY).encode('utf-8'))
+    return b''.join(chunks)
+
+class ChunkedReader:
+    """A reader that returns at most chunk_size bytes per read.
+    """
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+
+    async def read(self, n=-1):
+        n = self.chunk_size if n < 0 else min(n, self.chunk_size)
+        chunk, self.data = self.data[:n], self.data[n:]
+        return chunk
+
+def make_multipart_request(body, chunk_size=65536, method=POST,
+                           path='/_test/upload'):
+    reader = ChunkedReader(body, chunk_size)
+    request = make_request(
+        method=method,
+        path=path,
+        headers={
+            'content-type':
+                'multipart/form-data; boundary="{}"'.format(BOUNDARY),
+            'content-length': str(len(body)),
+        }
+    )
+    return request._replace(reader=reader, body=reader)
+
+class MultipartTester(TestCase):
+    PARTS = [
+        ('a', None, b'1'),
+        ('a', None, b'2'),
+        ('f', 'x.bin', bytes(range(256)) * 100),
+        ('empty', 'empty.txt', b''),
+        # A part body that contains a partial delimiter.
+        ('g', 'g.txt', b'\r\n--xYz\r\n--'),
+    ]
+
+    def _parts(self, chunk_size, **kwargs):
+        async def f():
+            request = make_multipart_request(
+                encode_multipart(self.PARTS), chunk_size
+            )
+            parts = []
+            async for part in MultipartParser(request, **kwargs):
+                chunks = [chunk async for chunk in part]
+                self.assertNotIn(b'', chunks)
+                parts.append((part.name, part.filename, b''.join(chunks)))
+            return parts
+        return asyncio.run(f())
+
+    def test_parts(self):
+        for chunk_size in (1, 7, 100, 65536):
+            self.assertEqual(self._parts(chunk_size), self.PARTS)
+
+    def test_max_part_bytes(self):
+        with self.assertRaises(PayloadTooLarge):
+            self._parts(1000, max_part_bytes=25599)
+        self.assertEqual(self._parts(1000, max_part_bytes=25600), self.PARTS)
+
+    def test_max_total_bytes(self):
+        with self.assertRaises(PayloadTooLarge):
+            self._parts(1000, max_total_bytes=1000)
+
+    def test_missing_boundary(self):
+        request = make_request(
+            method=POST, headers={'content-type': 'multipart/form-data'}
+        )
+        with self.assertRaises(CouldNotParse):
+            MultipartParser(request)
+
+    def test_truncated_body(self):
+        async def f():
+            body = encode_multipart(self.PARTS)[:-20]
+            request = make_multipart_request(body)
+            request.headers['content-length'] = str(len(body))
+            async for part in MultipartParser(request):
+                pass
+        with self.assertRaises(CouldNotParse):
+            asyncio.run(f())
+
+    def test_parse_form_spools_large_files(self):
+        async def f():
+            request = make_multipart_request(encode_multipart(self.PARTS))
+            return await parse_form(request, spool_threshold=1000)
+        form = asyncio.run(f())
+        try:
+            self.assertEqual(form.fields, {'a': ['1', '2']})
+            large = form.files['f'][0]
+            self.assertEqual(large.filename, 'x.bin')
+            self.assertTrue(large.file._rolled)
+            self.assertEqual(large.file.read(), self.PARTS[2][2])
+            self.assertFalse(form.files['g'][0].file._rolled)
+        finally:
+            form.close()
+
+    def test_multipart_request_decorator(self):
+        @multipart_request(max_part_bytes=1000)
+        async def handler(request, form):
+            return _200(body=form.fields['a'][0])
+        response = asyncio.run(handler(
+            make_multipart_request(encode_multipart(self.PARTS[:2]))
+        ))
+        self.assertEqual(response.body, '1')
+        response = asyncio.run(handler(
+            make_multipart_request(encode_multipart(self.PARTS))
+        ))
+        self.assertEqual(response.status_int, 413)
+        response = asyncio.run(handler(make_request(method=POST)))
+        self.assertEqual(response.status_int, 400)
+
+
+class FilesystemMultipartTester(FilesystemTestCase):
+    def test_upload(self):
+        parts = [
+            ('files', 'new.txt', b'new'),
+            ('files', '../../escape.txt', b'escape'),
+            ('other', None, b'ignored'),
+        ]
+        request = make_multipart_request(
+            encode_multipart(parts), 5, path='/_fs/dir'
+        )
+        response = asyncio.run(filesystem(request, self.root))
+        self.assertEqual(response.status_int, 303)
+        self.assertEqual(response.headers['location'], '/_fs/dir/')
+        dir_path = os.path.join(self.root, 'dir')
+        with open(os.path.join(dir_path, 'new.txt'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'new')
+        with open(os.path.join(dir_path, 'escape.txt'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'escape')
+        self.assertEqual(
+            sorted(os.listdir(dir_path)),
+            ['a.txt', 'escape.txt', 'new.txt', 'sub']
+        )
+
+    def test_upload_limits(self):
+        parts = [('files', 'big.txt', b'x' * 100)]
+        for kwargs in ({'max_part_bytes': 99}, {'max_total_bytes': 99}):
+            request = make_multipart_request(
+                encode_multipart(parts), path='/_fs/dir'
+            )
+            with self.assertRaises(PayloadTooLarge):
+                asyncio.run(filesystem(request, self.root, **kwargs))
+        self.assertNotIn('big.txt', os.listdir(os.path.join(self.root, 'dir')))
+
+
+class Upstream:
+    """A stand-in keep-alive upstream server that responds to paths ending
+    in:
+      /echo - with a JSON description of the request
+      /chunked - with a chunked body
+      /slow - like /echo, after 0.2 seconds
+      /close - with a "connection: close" response
+      /drop - with a keep-alive response, and then by closing the connection
+              without a response when it receives the next request
+    """
+    async def start(self):
+        self.connections = 0
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        drop = False
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except asyncio.IncompleteReadError:
+                    return
+                request_line, *header_lines = head[:-4].decode().split('\r\n')
+                method, target, _ = request_line.split()
+                # Respond according to the last path segment.
+                name = target.partition('?')[0].rsplit('/', 1)[1]
+                headers = dict(
+                    (k.lower(), v.strip()) for k, _, v in
+                    (line.partition(':') for line in header_lines)
+                )
+                body = await reader.readexactly(
+                    int(headers.get('content-length', 0))
+                )
+                if drop:
+                    return
+                drop = name == 'drop'
+                if name == 'slow':
+                    await asyncio.sleep(0.2)
+                if name == 'chunked':
+                    writer.write(
+                        b'HTTP/1.1 200 OK\r\ntransfer-encoding: chunked\r\n'
+                        b'\r\n5\r\nhello\r\n5\r\nworld\r\n0\r\n\r\n'
+                    )
+                    continue
+                data = json.dumps({
+                    'method': method,
+                    'target': target,
+                    'headers': headers,
+                    'body_length': len(body),
+                }).encode()
+                writer.write(
+                    'HTTP/1.1 200 OK\r\ncontent-length: {}\r\n{}\r\n'.format(
+                        len(data), 'connection: close\r\n'
+                        if name == 'close' else ''
+                    ).encode() + data
+                )
+                await writer.drain()
+                if name == 'close':
+                    return
+        finally:
+            writer.close()
+
+
+class ProxyTester(TestCase):
+    async def _request(self, port, data):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(data)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        head, _, body = response.partition(b'\r\n\r\n')
+        return head, body
+
+    def _test(self, name, f, **kwargs):
+        async def g():
+            upstream = await Upstream().start()
+            pool = proxy_route(
+                '/_test/proxy/{}/.*'.format(name),
+                'http://127.0.0.1:{}/up'.format(upstream.port),
+                **kwargs
+            )
+            server = await serve('127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            async def request(path, data=b'', method='GET'):
+                return await self._request(port, (
+                    '{} /_test/proxy/{}{} HTTP/1.1\r\nhost: example.com\r\n'
+                    'content-length: {}\r\nconnection: keep-alive\r\n\r\n'
+                    .format(method, name, path, len(data)).encode() + data
+                ))
+            try:
+                return await f(request, upstream, pool)
+            finally:
+                server.close()
+                await server.wait_closed()
+                await upstream.stop()
+        return asyncio.run(g())
+
+    def test_forwarding_and_reuse(self):
+        async def f(request, upstream, pool):
+            head, body = await request('/echo?x=1')
+            self.assertTrue(head.startswith(b'HTTP/1.1 200 OK'))
+            self.assertIn(b'connection: close', head)
+            echo = json.loads(body)
+            self.assertEqual(echo['target'], '/up/_test/proxy/reuse/echo?x=1')
+            headers = echo['headers']
+            self.assertEqual(headers['host'],
+                             '127.0.0.1:{}'.format(upstream.port))
+            self.assertEqual(headers['x-forwarded-host'], 'example.com')
+            self.assertEqual(headers['x-forwarded-for'], '127.0.0.1')
+            self.assertNotIn('connection', headers)
+
+            data = os.urandom(300000)
+            head, body = await request('/echo', data, method=PUT)
+            self.assertEqual(json.loads(body)['body_length'], len(data))
+
+            head, body = await request('/chunked')
+            self.assertIn(b'transfer-encoding: chunked', head)
+            self.assertEqual(body, b'5\r\nhello\r\n5\r\nworld\r\n0\r\n\r\n')
+
+            self.assertEqual(upstream.connections, 1)
+            self.assertEqual(pool.stats()['reused'], 2)
+        self._test('reuse', f)
+
+    def test_idle_ttl(self):
+        async def f(request, upstream, pool):
+            await request('/echo')
+            await asyncio.sleep(0.1)
+            await request('/echo')
+            self.assertEqual(upstream.connections, 2)
+            self.assertEqual(pool.stats()['evicted'], 1)
+        self._test('ttl', f, idle_ttl=0.05)
+
+    def test_max_size(self):
+        async def f(request, upstream, pool):
+            responses = await asyncio.gather(
+                *(request('/echo') for _ in range(4))
+            )
+            for head, body in responses:
+                self.assertTrue(head.startswith(b'HTTP/1.1 200 OK'))
+            self.assertEqual(upstream.connections, 2)
+            self.assertEqual(pool.stats()['idle'], 2)
+            self.assertEqual(pool.stats()['active'], 0)
+        self._test('max_size', f, max_size=2)
+
+    def test_pool_timeout(self):
+        async def f(request, upstream, pool):
+            (slow, _), (timed_out, _) = await asyncio.gather(
+                request('/slow'), request('/slow')
+            )
+            self.assertTrue(slow.startswith(b'HTTP/1.1 200 OK'))
+            self.assertTrue(timed_out.startswith(b'HTTP/1.1 503'))
+            self.assertEqual(upstream.connections, 1)
+        self._test('pool_timeout', f, max_size=1, pool_timeout=0.05)
+
+    def test_connection_close(self):
+        async def f(request, upstream, pool):
+            await request('/close')
+            self.assertEqual(pool.stats()['idle'], 0)
+            await request('/echo')
+            self.assertEqual(upstream.connections, 2)
+        self._test('close', f)
+
+    def test_stale_connection_is_retried(self):
+        async def f(request, upstream, pool):
+            await request('/drop')
+            head, body = await request('/echo')
+            self.assertTrue(head.startswith(b'HTTP/1.1 200 OK'))
+            self.assertEqual(pool.stats()['reused'], 1)
+            self.assertEqual(upstream.connections, 2)
+        self._test('stale', f)
+
+    def test_stale_connection_is_not_retried_for_post(self):
+        async def f(request, upstream, pool):
+            await request('/drop')
+            head, body = await request('/echo', method=POST)
+            self.assertTrue(head.startswith(b'HTTP/1.1 502'))
+            self.assertEqual(pool.stats()['reused'], 1)
+            self.assertEqual(upstream.connections, 1)
+        self._test('stale_post', f)
+
+    def test_upstream_down(self):
+        async def f(request, upstream, pool):
+            await upstream.stop()
+            head, body = await request('/echo')
+            self.assertTrue(head.startswith(b'HTTP/1.1 502'))
+        self._test('down', f)
+
+    def test_invalid_upstream(self):
+        with self.assertRaises(ValueError):
+            proxy_route('/_test/proxy/invalid', 'ftp://127.0.0.1')